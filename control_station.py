@@ -15,6 +15,7 @@ from dynamixel_XL import *
 from dynamixel_AX import *
 from dynamixel_MX import *
 from dynamixel_bus import *
+from dynamixel_group import *
 
 from ui import Ui_MainWindow
 from rexarm import Rexarm
@@ -41,19 +42,28 @@ DEVICENAME = "/dev/ttyACM0".encode('utf-8')
 worldcoords = 0
 """Threads"""
 class VideoThread(QThread):
-    updateFrame = pyqtSignal(QImage, QImage)
+    updateFrame = pyqtSignal(QImage)
 
     def __init__(self, kinect, parent=None):
         QThread.__init__(self, parent=parent) 
         self.kinect = kinect
+        # view shown by the Gui ("video", "depth" or None), only that one is rendered
+        self.view = "video"
 
     def run(self):
+        # capture runs on its own thread, this one only converts the newest pair
+        self.kinect.start_capture()
         while True:
-            self.kinect.captureVideoFrame()
-            self.kinect.captureDepthFrame()
-            rgb_frame = self.kinect.convertFrame()
-            depth_frame = self.kinect.convertDepthFrame()
-            self.updateFrame.emit(rgb_frame, depth_frame)
+            view = self.view
+            frame = self.kinect.latest_frame() if view is not None else None
+            if frame is not None:
+                with frame:
+                    if(view == "depth"):
+                        image = self.kinect.convertDepthFrame(frame)
+                    else:
+                        image = self.kinect.convertFrame(frame)
+                if image is not None:
+                    self.updateFrame.emit(image)
             time.sleep(.03)
 
 class LogicThread(QThread):   
@@ -79,8 +89,10 @@ class DisplayThread(QThread):
     def run(self):
         while True:
             self.updateStatusMessage.emit(self.sm.status_message)
-            self.updateJointReadout.emit(self.rexarm.joint_angles_fb)
-            self.updateEndEffectorReadout.emit(self.rexarm.get_wrist_pose())
+            # joint and end effector readouts from the same snapshot
+            feedback = self.rexarm.get_snapshot()
+            self.updateJointReadout.emit(list(feedback.positions))
+            self.updateEndEffectorReadout.emit(self.rexarm.get_wrist_pose(feedback))
             #print(FK_dh(self.rexarm.get_positions()))
             #print(np.matmul(FK_dh(self.rexarm.get_positions()),self.rexarm.get_positions()))
             #print(self.rexarm.get_positions())
@@ -122,7 +134,10 @@ class Gui(QMainWindow):
 
         """Objects Using Other Classes"""
         self.kinect = Kinect()
-        self.rexarm = Rexarm((base,shld,elbw,wrst,wrst2,wrst3), grip)
+        joints = (base,shld,elbw,wrst,wrst2,wrst3)
+        self.rexarm = Rexarm(joints, grip,
+                             sync_write = DXL_SYNC_WRITE(port_num, joints),
+                             bulk_read = DXL_BULK_READ(port_num, joints))
         #self.rexarm = Rexarm((base,shld,elbw,wrst,wrst2), 0)
         self.tp = TrajectoryPlanner(self.rexarm, self.kinect)
         self.sm = StateMachine(self.rexarm, self.tp, self.kinect)
@@ -169,10 +184,13 @@ class Gui(QMainWindow):
 
         """initalize rexarm"""
         self.rexarm.initialize()
+        self.rexarm.start_io()
 
         """Setup Threads"""
         self.videoThread = VideoThread(self.kinect)
         self.videoThread.updateFrame.connect(self.setImage)        
+        self.ui.radioVideo.toggled.connect(self.setView)
+        self.ui.radioDepth.toggled.connect(self.setView)
         self.videoThread.start()
 
         
@@ -196,12 +214,18 @@ class Gui(QMainWindow):
 
     """ Slots attach callback functions to signals emitted from threads"""
 
-    @pyqtSlot(QImage, QImage)
-    def setImage(self, rgb_image, depth_image):
+    @pyqtSlot(QImage)
+    def setImage(self, image):
+        self.ui.videoDisplay.setPixmap(QPixmap.fromImage(image))
+
+    def setView(self):
+        """ Tell the video thread which view to render """
         if(self.ui.radioVideo.isChecked()):
-            self.ui.videoDisplay.setPixmap(QPixmap.fromImage(rgb_image))
-        if(self.ui.radioDepth.isChecked()):
-            self.ui.videoDisplay.setPixmap(QPixmap.fromImage(depth_image))
+            self.videoThread.view = "video"
+        elif(self.ui.radioDepth.isChecked()):
+            self.videoThread.view = "depth"
+        else:
+            self.videoThread.view = None
 
     @pyqtSlot(list)
     def updateJointReadout(self, joints):
@@ -306,7 +330,7 @@ class Gui(QMainWindow):
                            self.ui.sldrWrist2.value()*D2R,
                            self.ui.sldrWrist3.value()*D2R])
         self.rexarm.set_positions(joint_positions, update_now = False)
-        self.rexarm.gripper.set_position(np.array([self.ui.sldrGrip1.value()*D2R]))
+        self.rexarm.dispatch(self.rexarm.gripper.set_position, np.array([self.ui.sldrGrip1.value()*D2R]))
 
     def directControlChk(self, state):
         if state == Qt.Checked:
@@ -345,8 +369,10 @@ class Gui(QMainWindow):
             y = y - MIN_Y
 
             # Checking if the Kinect depth camera is producing output
-            if(self.kinect.currentDepthFrame.any() != 0):
-                z = self.kinect.currentDepthFrame[y][x]
+            frame = self.kinect.latest_frame()
+            if(frame is not None):
+                with frame:
+                    z = frame.depth[y][x]
                 # Display the x,y (pixels), z (10 bit number) coordinates
                 self.ui.rdoutMousePixels.setText("(%.0f,%.0f,%.0f)" % (x,y,z))
 
@@ -357,13 +383,8 @@ class Gui(QMainWindow):
                  	# 		CAMERA FRAME TO DEPTH FRAME         #
                  	#############################################
 
-                    # Taking in the pixel values in camera frame and transforming to the kinect depth frame
-                    pixel_value=np.array([x,y])
-                    # Converting 10 bit depth to real distance using provided analytical function
-                    z = self.kinect.currentDepthFrame[int(pixel_value.item(1))][int(pixel_value.item(0))]
-                    Z = 12.36 * np.tan(float(z)/2842.5 + 1.1863)
-                    # 95 cm marks the z location of the base plane wrt to the camera. Subtracting 95 to measure +z from the base plane
-                    Z_modified = 95-Z
+                    # Height above the base plane in cm, looked up from the depth model
+                    Z_modified = self.sm.find_z_at_xy(x,y)
                     
                     #############################################
                     # 		CAMERA FRAME TO WORLD FRAME         #
@@ -397,7 +418,6 @@ class Gui(QMainWindow):
                     # world_value = xyz_c*rot
                     # -0.197*float(z) + 142.772
                     # self.kinect.detectBlocksInDepthImage()
-                    # self.kinect.processVideoFrame() 
 
 
                     # Displaying the World X,Y and Z coordinates in GUI
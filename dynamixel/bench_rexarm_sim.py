@@ -0,0 +1,61 @@
+import os
+import time
+os.environ["DXL_SIM"] = "1"                  # use the in-process simulator
+os.sys.path.append('dynamixel/')             # Path setting
+os.sys.path.append('.')
+import dynamixel_functions
+from dynamixel_XL import *
+from dynamixel_AX import *
+from dynamixel_MX import *
+from dynamixel_bus import *
+from dynamixel_group import *
+from rexarm import Rexarm
+from trajectory_planner import TrajectoryPlanner
+
+"""
+Headless benchmark: runs the same quintic trajectory through the per-joint
+and the group (sync write / bulk read) paths on the simulated bus and
+reports transactions and bus time per tick.  Run from the repo root:
+    python dynamixel/bench_rexarm_sim.py
+"""
+
+BAUDRATE   = 1000000
+DEVICENAME = "/dev/ttyACM0".encode('utf-8')
+
+sim = dynamixel_functions.dxl_lib
+dxlbus = DXL_BUS(DEVICENAME, BAUDRATE)
+port_num = dxlbus.port()
+
+base = DXL_MX(port_num, 1)
+shld = DXL_MX(port_num, 2)
+elbw = DXL_MX(port_num, 3)
+wrst = DXL_AX(port_num, 4)
+wrst2 = DXL_AX(port_num, 5)
+wrst3 = DXL_XL(port_num, 7)
+grip = DXL_XL(port_num, 6)
+joints = (base,shld,elbw,wrst,wrst2,wrst3)
+
+def run(rexarm, label):
+    rexarm.initialize()
+    tp = TrajectoryPlanner(rexarm, None)
+    tp.set_final_wp([1.0,0.8,1.0,0.5,1.0,0.0])
+    initial_wp = tp.set_initial_wp()
+    final_wp = tp.set_final_wp([0.0]*rexarm.num_joints)
+    T = tp.calc_time_from_waypoints(initial_wp, final_wp, 0.5)
+    plan_pts, plan_velos = tp.generate_quintic_spline(initial_wp, final_wp, T)
+    sim.reset_stats()
+    start = time.time()
+    tp.execute_plan(plan_pts, plan_velos)
+    wall = time.time() - start
+    stats = tp.exec_stats
+    ticks = stats["ticks"]
+    print("%-10s ticks %3d  transactions/tick %6.1f  bus ms/tick %6.2f  wall %.2f s (planned %.2f s)  overruns %d  max jitter %.1f ms  look-ahead %d" % (
+        label, ticks, sim.stats["transactions"]/float(ticks),
+        1000.0*sim.stats["bus_time"]/ticks, wall, ticks*tp.dt,
+        stats["overruns"], 1000.0*stats["max_jitter"], stats["look_ahead"]))
+
+run(Rexarm(joints, grip), "per-joint")
+run(Rexarm(joints, grip, sync_write = DXL_SYNC_WRITE(port_num, joints),
+           bulk_read = DXL_BULK_READ(port_num, joints)), "group")
+
+dxlbus.close()
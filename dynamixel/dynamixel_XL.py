@@ -1,4 +1,5 @@
 import dynamixel_functions as dxl
+from dynamixel_mirror import RegisterMirror
 
 # Control table address for Dynamixel XL
 #                         ADDR      ACCESS  BYTES
@@ -40,16 +41,23 @@ ADDR_PUNCH               = 51   #   RW      2
 PROTOCOL                 = 2
 VERBOSE                  = 0
 RETRIES                  = 30
+# PRESENT_POSITION through MOVING, read as one block for feedback
+LEN_FEEDBACK             = ADDR_MOVING - ADDR_PRESENT_POSITION + 1
 
 def print_v(arg):
     if(VERBOSE):
         print(arg)
 
-class DXL_XL:
+class DXL_XL(RegisterMirror):
     def __init__(self, port, id):
         self.type = "XL"
         self.port = port
         self.id = id
+        self.protocol = PROTOCOL
+        self.fb_addr = ADDR_PRESENT_POSITION
+        self.fb_len = LEN_FEEDBACK
+        # RAM register mirror, see stage() and flush()
+        RegisterMirror.__init__(self)
         self.mode = self.get_mode()
         self.max_speed = 11.89 #rad/s
 
@@ -155,65 +163,24 @@ class DXL_XL:
                 print_v(dxl.getRxPacketError(PROTOCOL, derror))
                 retry +=1
             else:
+                # the arm may be moved by hand now, resend everything later
+                self.invalidate()
                 return 0
         raise Exception("disable_torque failed after {} tries".format(num_tries))
 
     # set_position() takes position in radians from -pi to pi
     def set_position(self, pos, num_tries = RETRIES):
-        value = self.rad2value(pos)
-        retry = 0
-        while(retry < num_tries):
-            dxl.write2ByteTxRx(self.port, PROTOCOL, self.id, ADDR_GOAL_POSITION, value)
-            dcomm_result = dxl.getLastTxRxResult(self.port, PROTOCOL)
-            derror = dxl.getLastRxPacketError(self.port, PROTOCOL)
-            if dcomm_result != 0:
-                print_v(dxl.getTxRxResult(PROTOCOL, dcomm_result))
-                retry +=1
-            elif derror != 0:
-                print_v(dxl.getRxPacketError(PROTOCOL, derror))
-                retry +=1
-            else:
-                return 0
-        raise Exception("set_position failed after {} tries".format(num_tries))
+        self.stage(ADDR_GOAL_POSITION, 2, self.rad2value(pos))
+        return self.flush(num_tries)
 
     # set_speed() takes -1.0 to 1.0
     def set_speed(self, speed, num_tries = RETRIES):
-        if(self.mode == 2):
-            value = int(1023*abs(speed))
-        elif(self.mode == 1):
-            value = int(1023*abs(speed))
-            if(speed>0.0):
-                value = value + 1024
-        retry = 0
-        while(retry < num_tries):
-            dxl.write2ByteTxRx(self.port, PROTOCOL, self.id, ADDR_MOVING_SPEED, value)
-            dcomm_result = dxl.getLastTxRxResult(self.port, PROTOCOL)
-            derror = dxl.getLastRxPacketError(self.port, PROTOCOL)
-            if dcomm_result != 0:
-                print_v(dxl.getTxRxResult(PROTOCOL, dcomm_result))
-                retry +=1
-            elif derror != 0:
-                print_v(dxl.getRxPacketError(PROTOCOL, derror))
-                retry +=1
-            else:
-                return 0
-        raise Exception("set_speed failed after {} tries".format(num_tries))
+        self.stage(ADDR_MOVING_SPEED, 2, self.speed2value(speed))
+        return self.flush(num_tries)
 
     def set_torque_limit(self, torque, num_tries = RETRIES):
-        retry = 0
-        while(retry < num_tries):
-            dxl.write2ByteTxRx(self.port, PROTOCOL, self.id, ADDR_TORQUE_LIMIT, int(torque * 1023))
-            dcomm_result = dxl.getLastTxRxResult(self.port, PROTOCOL)
-            derror = dxl.getLastRxPacketError(self.port, PROTOCOL)
-            if dcomm_result != 0:
-                print_v(dxl.getTxRxResult(PROTOCOL, dcomm_result))
-                retry +=1
-            elif derror != 0:
-                print_v(dxl.getRxPacketError(PROTOCOL, derror))
-                retry +=1
-            else:
-                return 0
-        raise Exception("set_torque_limit failed after {} tries".format(num_tries))
+        self.stage(ADDR_TORQUE_LIMIT, 2, int(torque * 1023))
+        return self.flush(num_tries)
 
     def get_position(self, num_tries = RETRIES):
         retry = 0
@@ -245,10 +212,7 @@ class DXL_XL:
                 print_v(dxl.getRxPacketError(PROTOCOL, derror))
                 retry +=1
             else:
-                if(speed > 1024):
-                    return (speed & 1023)/1023.0
-                else:
-                    return -(speed & 1023)/1023.0
+                return self.value2norm(speed)
         raise Exception("get_speed failed after {} tries".format(num_tries))
 
     def get_load(self, num_tries = RETRIES):
@@ -265,10 +229,7 @@ class DXL_XL:
                 print_v(dxl.getRxPacketError(PROTOCOL, derror))
                 retry +=1
             else:
-                if(load > 1024):
-                    return (load & 1023)/1023.0
-                else:
-                    return -(load & 1023)/1023.0
+                return self.value2norm(load)
         raise Exception("get_load failed after {} tries".format(num_tries))
 
     def get_temp(self, num_tries = RETRIES):
@@ -320,6 +281,51 @@ class DXL_XL:
         raise Exception("is_moving failed after {} tries".format(num_tries))
 
 
+    def get_feedback(self, num_tries = RETRIES):
+        # one block read instead of a round trip per register
+        retry = 0
+        while(retry < num_tries):
+            dxl.readTxRx(self.port, PROTOCOL, self.id, ADDR_PRESENT_POSITION, LEN_FEEDBACK)
+            dcomm_result = dxl.getLastTxRxResult(self.port, PROTOCOL)
+            derror = dxl.getLastRxPacketError(self.port, PROTOCOL)
+            if dcomm_result != 0:
+                print_v(dxl.getTxRxResult(PROTOCOL, dcomm_result))
+                retry +=1
+            elif derror != 0:
+                print_v(dxl.getRxPacketError(PROTOCOL, derror))
+                retry +=1
+            else:
+                return self.decode_feedback(lambda addr, length:
+                    dxl.getDataRead(self.port, PROTOCOL, length, addr - ADDR_PRESENT_POSITION))
+        raise Exception("get_feedback failed after {} tries".format(num_tries))
+
+    # decode_feedback() takes read(addr, length) returning the raw register
+    # value and returns (position, speed, load, temp, moving)
+    def decode_feedback(self, read):
+        return (self.value2rad(read(ADDR_PRESENT_POSITION, 2)),
+                self.value2norm(read(ADDR_PRESENT_SPEED, 2)),
+                self.value2norm(read(ADDR_PRESENT_LOAD, 2)),
+                read(ADDR_PRESENT_TEMP, 1),
+                read(ADDR_MOVING, 1))
+
+    def value2norm(self, value):
+        # speed and load registers: bit 10 is direction, bits 0-9 magnitude
+        if(value > 1024):
+            return (value & 1023)/1023.0
+        else:
+            return -(value & 1023)/1023.0
+
+    def speed2value(self, speed):
+        value = int(1023*abs(speed))
+        if((self.mode == 1) & (speed > 0.0)):
+            value = value + 1024
+        return value
+
+    # goal_param() packs goal position and moving speed into the 4 byte
+    # block starting at ADDR_GOAL_POSITION, for use with group sync writes
+    def goal_param(self, pos, speed):
+        return self.rad2value(pos) | (self.speed2value(speed) << 16)
+
     def deg2value(self, angle):
         return int(1023*(angle + 150.0)/300)
 
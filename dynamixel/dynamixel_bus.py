@@ -4,8 +4,6 @@ import dynamixel_functions as dynamixel
 
 class DXL_BUS:
     def __init__(self,device,baud):
-        self.fd = sys.stdin.fileno()
-        self.old_settings = termios.tcgetattr(self.fd)
         self.port_num = dynamixel.portHandler(device)
         dynamixel.packetHandler()
 
@@ -34,6 +32,8 @@ class DXL_BUS:
         dynamixel.closePort(self.port_num)
 
     def getch(self):
+        self.fd = sys.stdin.fileno()
+        self.old_settings = termios.tcgetattr(self.fd)
         try:
             tty.setraw(sys.stdin.fileno())
             ch = sys.stdin.read(1)
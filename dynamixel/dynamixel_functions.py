@@ -19,155 +19,165 @@
 
 # Author: Ryu Woon Jung (Leon)
 
+import os
 import ctypes
 from ctypes import cdll
 # dxl_lib = cdll.LoadLibrary("lib/dxl_x86_c.dll")  # for windows 32bit
 # dxl_lib = cdll.LoadLibrary("lib/dxl_x64_c.dll")  # for windows 64bit
 # dxl_lib = cdll.LoadLibrary("lib/libdxl_x86_c.so")   # for linux 32bit
-dxl_lib = cdll.LoadLibrary("lib/libdxl_x64_c.so")     # for linux 64bit
 # dxl_lib = cdll.LoadLibrary("lib/libdxl_sbc_c.so")   # for SBC linux
 # dxl_lib = cdll.LoadLibrary("lib/libdxl_mac_c.dylib")# for Mac OS
+if os.environ.get("DXL_SIM"):
+    # in-process simulator, no hardware. Module attributes are looked up on
+    # it when used, so a function it does not simulate raises AttributeError
+    from dynamixel_sim import SimLib
+    dxl_lib = SimLib()
 
-# port_handler
-portHandler = dxl_lib.portHandler
+    def __getattr__(name):
+        return getattr(dxl_lib, name)
+else:
+    dxl_lib = cdll.LoadLibrary("lib/libdxl_x64_c.so")     # for linux 64bit
 
-openPort = dxl_lib.openPort
-closePort = dxl_lib.closePort
-clearPort = dxl_lib.clearPort
+    # port_handler
+    portHandler = dxl_lib.portHandler
 
-setPortName = dxl_lib.setPortName
-getPortName = dxl_lib.getPortName
+    openPort = dxl_lib.openPort
+    closePort = dxl_lib.closePort
+    clearPort = dxl_lib.clearPort
 
-setBaudRate = dxl_lib.setBaudRate
-getBaudRate = dxl_lib.getBaudRate
+    setPortName = dxl_lib.setPortName
+    getPortName = dxl_lib.getPortName
 
-readPort = dxl_lib.readPort
-writePort = dxl_lib.writePort
+    setBaudRate = dxl_lib.setBaudRate
+    getBaudRate = dxl_lib.getBaudRate
 
-setPacketTimeout = dxl_lib.setPacketTimeout
-setPacketTimeoutMSec = dxl_lib.setPacketTimeoutMSec
-isPacketTimeout = dxl_lib.isPacketTimeout
+    readPort = dxl_lib.readPort
+    writePort = dxl_lib.writePort
 
-# packet_handler
-packetHandler = dxl_lib.packetHandler
+    setPacketTimeout = dxl_lib.setPacketTimeout
+    setPacketTimeoutMSec = dxl_lib.setPacketTimeoutMSec
+    isPacketTimeout = dxl_lib.isPacketTimeout
 
-printTxRxResult = dxl_lib.printTxRxResult
-getTxRxResult = dxl_lib.getTxRxResult
-getTxRxResult.restype = ctypes.c_char_p
-printRxPacketError = dxl_lib.printRxPacketError
-getRxPacketError = dxl_lib.getRxPacketError
-getRxPacketError.restype = ctypes.c_char_p
+    # packet_handler
+    packetHandler = dxl_lib.packetHandler
 
-getLastTxRxResult = dxl_lib.getLastTxRxResult
-getLastRxPacketError = dxl_lib.getLastRxPacketError
+    printTxRxResult = dxl_lib.printTxRxResult
+    getTxRxResult = dxl_lib.getTxRxResult
+    getTxRxResult.restype = ctypes.c_char_p
+    printRxPacketError = dxl_lib.printRxPacketError
+    getRxPacketError = dxl_lib.getRxPacketError
+    getRxPacketError.restype = ctypes.c_char_p
 
-setDataWrite = dxl_lib.setDataWrite
-getDataRead = dxl_lib.getDataRead
+    getLastTxRxResult = dxl_lib.getLastTxRxResult
+    getLastRxPacketError = dxl_lib.getLastRxPacketError
 
-txPacket = dxl_lib.txPacket
+    setDataWrite = dxl_lib.setDataWrite
+    getDataRead = dxl_lib.getDataRead
 
-rxPacket = dxl_lib.rxPacket
+    txPacket = dxl_lib.txPacket
 
-txRxPacket = dxl_lib.txRxPacket
+    rxPacket = dxl_lib.rxPacket
 
-ping = dxl_lib.ping
+    txRxPacket = dxl_lib.txRxPacket
 
-pingGetModelNum = dxl_lib.pingGetModelNum
+    ping = dxl_lib.ping
 
-broadcastPing = dxl_lib.broadcastPing
-getBroadcastPingResult = dxl_lib.getBroadcastPingResult
+    pingGetModelNum = dxl_lib.pingGetModelNum
 
-reboot = dxl_lib.reboot
+    broadcastPing = dxl_lib.broadcastPing
+    getBroadcastPingResult = dxl_lib.getBroadcastPingResult
 
-factoryReset = dxl_lib.factoryReset
+    reboot = dxl_lib.reboot
 
-readTx = dxl_lib.readTx
-readRx = dxl_lib.readRx
-readTxRx = dxl_lib.readTxRx
+    factoryReset = dxl_lib.factoryReset
 
-read1ByteTx = dxl_lib.read1ByteTx
-read1ByteRx = dxl_lib.read1ByteRx
-read1ByteTxRx = dxl_lib.read1ByteTxRx
+    readTx = dxl_lib.readTx
+    readRx = dxl_lib.readRx
+    readTxRx = dxl_lib.readTxRx
 
-read2ByteTx = dxl_lib.read2ByteTx
-read2ByteRx = dxl_lib.read2ByteRx
-read2ByteTxRx = dxl_lib.read2ByteTxRx
+    read1ByteTx = dxl_lib.read1ByteTx
+    read1ByteRx = dxl_lib.read1ByteRx
+    read1ByteTxRx = dxl_lib.read1ByteTxRx
 
-read4ByteTx = dxl_lib.read4ByteTx
-read4ByteRx = dxl_lib.read4ByteRx
-read4ByteTxRx = dxl_lib.read4ByteTxRx
+    read2ByteTx = dxl_lib.read2ByteTx
+    read2ByteRx = dxl_lib.read2ByteRx
+    read2ByteTxRx = dxl_lib.read2ByteTxRx
 
-writeTxOnly = dxl_lib.writeTxOnly
-writeTxRx = dxl_lib.writeTxRx
+    read4ByteTx = dxl_lib.read4ByteTx
+    read4ByteRx = dxl_lib.read4ByteRx
+    read4ByteTxRx = dxl_lib.read4ByteTxRx
 
-write1ByteTxOnly = dxl_lib.write1ByteTxOnly
-write1ByteTxRx = dxl_lib.write1ByteTxRx
+    writeTxOnly = dxl_lib.writeTxOnly
+    writeTxRx = dxl_lib.writeTxRx
 
-write2ByteTxOnly = dxl_lib.write2ByteTxOnly
-write2ByteTxRx = dxl_lib.write2ByteTxRx
+    write1ByteTxOnly = dxl_lib.write1ByteTxOnly
+    write1ByteTxRx = dxl_lib.write1ByteTxRx
 
-write4ByteTxOnly = dxl_lib.write4ByteTxOnly
-write4ByteTxRx = dxl_lib.write4ByteTxRx
+    write2ByteTxOnly = dxl_lib.write2ByteTxOnly
+    write2ByteTxRx = dxl_lib.write2ByteTxRx
 
-regWriteTxOnly = dxl_lib.regWriteTxOnly
-regWriteTxRx = dxl_lib.regWriteTxRx
+    write4ByteTxOnly = dxl_lib.write4ByteTxOnly
+    write4ByteTxRx = dxl_lib.write4ByteTxRx
 
-syncReadTx = dxl_lib.syncReadTx
-# syncReadRx   -> GroupSyncRead
-# syncReadTxRx -> GroupSyncRead
+    regWriteTxOnly = dxl_lib.regWriteTxOnly
+    regWriteTxRx = dxl_lib.regWriteTxRx
 
-syncWriteTxOnly = dxl_lib.syncWriteTxOnly
+    syncReadTx = dxl_lib.syncReadTx
+    # syncReadRx   -> GroupSyncRead
+    # syncReadTxRx -> GroupSyncRead
 
-bulkReadTx = dxl_lib.bulkReadTx
-# bulkReadRx   -> GroupBulkRead
-# bulkReadTxRx -> GroupBulkRead
+    syncWriteTxOnly = dxl_lib.syncWriteTxOnly
 
-bulkWriteTxOnly = dxl_lib.bulkWriteTxOnly
+    bulkReadTx = dxl_lib.bulkReadTx
+    # bulkReadRx   -> GroupBulkRead
+    # bulkReadTxRx -> GroupBulkRead
 
-# group_bulk_read
-groupBulkRead = dxl_lib.groupBulkRead
+    bulkWriteTxOnly = dxl_lib.bulkWriteTxOnly
 
-groupBulkReadAddParam = dxl_lib.groupBulkReadAddParam
-groupBulkReadRemoveParam = dxl_lib.groupBulkReadRemoveParam
-groupBulkReadClearParam = dxl_lib.groupBulkReadClearParam
+    # group_bulk_read
+    groupBulkRead = dxl_lib.groupBulkRead
 
-groupBulkReadTxPacket = dxl_lib.groupBulkReadTxPacket
-groupBulkReadRxPacket = dxl_lib.groupBulkReadRxPacket
-groupBulkReadTxRxPacket = dxl_lib.groupBulkReadTxRxPacket
+    groupBulkReadAddParam = dxl_lib.groupBulkReadAddParam
+    groupBulkReadRemoveParam = dxl_lib.groupBulkReadRemoveParam
+    groupBulkReadClearParam = dxl_lib.groupBulkReadClearParam
 
-groupBulkReadIsAvailable = dxl_lib.groupBulkReadIsAvailable
-groupBulkReadGetData = dxl_lib.groupBulkReadGetData
+    groupBulkReadTxPacket = dxl_lib.groupBulkReadTxPacket
+    groupBulkReadRxPacket = dxl_lib.groupBulkReadRxPacket
+    groupBulkReadTxRxPacket = dxl_lib.groupBulkReadTxRxPacket
 
-#group_bulk_write
-groupBulkWrite = dxl_lib.groupBulkWrite
+    groupBulkReadIsAvailable = dxl_lib.groupBulkReadIsAvailable
+    groupBulkReadGetData = dxl_lib.groupBulkReadGetData
 
-groupBulkWriteAddParam = dxl_lib.groupBulkWriteAddParam
-groupBulkWriteRemoveParam = dxl_lib.groupBulkWriteRemoveParam
-groupBulkWriteChangeParam = dxl_lib.groupBulkWriteChangeParam
-groupBulkWriteClearParam = dxl_lib.groupBulkWriteClearParam
+    #group_bulk_write
+    groupBulkWrite = dxl_lib.groupBulkWrite
 
-groupBulkWriteTxPacket = dxl_lib.groupBulkWriteTxPacket
+    groupBulkWriteAddParam = dxl_lib.groupBulkWriteAddParam
+    groupBulkWriteRemoveParam = dxl_lib.groupBulkWriteRemoveParam
+    groupBulkWriteChangeParam = dxl_lib.groupBulkWriteChangeParam
+    groupBulkWriteClearParam = dxl_lib.groupBulkWriteClearParam
 
-#group_sync_read
-groupSyncRead = dxl_lib.groupSyncRead
+    groupBulkWriteTxPacket = dxl_lib.groupBulkWriteTxPacket
 
-groupSyncReadAddParam = dxl_lib.groupSyncReadAddParam
-groupSyncReadRemoveParam = dxl_lib.groupSyncReadRemoveParam
-groupSyncReadClearParam = dxl_lib.groupSyncReadClearParam
+    #group_sync_read
+    groupSyncRead = dxl_lib.groupSyncRead
 
-groupSyncReadTxPacket = dxl_lib.groupSyncReadTxPacket
-groupSyncReadRxPacket = dxl_lib.groupSyncReadRxPacket
-groupSyncReadTxRxPacket = dxl_lib.groupSyncReadTxRxPacket
+    groupSyncReadAddParam = dxl_lib.groupSyncReadAddParam
+    groupSyncReadRemoveParam = dxl_lib.groupSyncReadRemoveParam
+    groupSyncReadClearParam = dxl_lib.groupSyncReadClearParam
 
-groupSyncReadIsAvailable = dxl_lib.groupSyncReadIsAvailable
-groupSyncReadGetData = dxl_lib.groupSyncReadGetData
+    groupSyncReadTxPacket = dxl_lib.groupSyncReadTxPacket
+    groupSyncReadRxPacket = dxl_lib.groupSyncReadRxPacket
+    groupSyncReadTxRxPacket = dxl_lib.groupSyncReadTxRxPacket
 
-#group_sync_write
-groupSyncWrite = dxl_lib.groupSyncWrite
+    groupSyncReadIsAvailable = dxl_lib.groupSyncReadIsAvailable
+    groupSyncReadGetData = dxl_lib.groupSyncReadGetData
 
-groupSyncWriteAddParam = dxl_lib.groupSyncWriteAddParam
-groupSyncWriteRemoveParam = dxl_lib.groupSyncWriteRemoveParam
-groupSyncWriteChangeParam = dxl_lib.groupSyncWriteChangeParam
-groupSyncWriteClearParam = dxl_lib.groupSyncWriteClearParam
+    #group_sync_write
+    groupSyncWrite = dxl_lib.groupSyncWrite
 
-groupSyncWriteTxPacket = dxl_lib.groupSyncWriteTxPacket
+    groupSyncWriteAddParam = dxl_lib.groupSyncWriteAddParam
+    groupSyncWriteRemoveParam = dxl_lib.groupSyncWriteRemoveParam
+    groupSyncWriteChangeParam = dxl_lib.groupSyncWriteChangeParam
+    groupSyncWriteClearParam = dxl_lib.groupSyncWriteClearParam
+
+    groupSyncWriteTxPacket = dxl_lib.groupSyncWriteTxPacket
@@ -0,0 +1,126 @@
+import dynamixel_functions as dxl
+
+# Goal position (2 bytes) is followed by moving speed (2 bytes) at the same
+# address in the MX, AX and XL control tables, so a single sync write packet
+# can carry both for every servo speaking the same protocol
+ADDR_GOAL_POSITION       = 30
+ADDR_MOVING_SPEED        = 32
+LEN_GOAL_POS_SPEED       = 4
+
+VERBOSE                  = 0
+RETRIES                  = 30
+
+def print_v(arg):
+    if(VERBOSE):
+        print(arg)
+
+class DXL_SYNC_WRITE:
+    """
+    Group command path for a chain of joints.  Instead of one
+    write2ByteTxRx round trip per joint and register, goal position and
+    moving speed of all joints are packed into one sync write packet per
+    protocol (MX/AX share protocol 1, XL uses protocol 2).  Sync writes
+    have no status packet, so a tick costs one transmission per protocol.
+    """
+    def __init__(self, port, joints):
+        self.port = port
+        self.groups = {}
+        for i,joint in enumerate(joints):
+            if joint.protocol not in self.groups:
+                group_num = dxl.groupSyncWrite(port, joint.protocol, ADDR_GOAL_POSITION, LEN_GOAL_POS_SPEED)
+                self.groups[joint.protocol] = (group_num, [])
+            self.groups[joint.protocol][1].append((i, joint))
+
+    # set_positions_speeds() takes positions in radians and normalized
+    # speeds (0.0 to 1.0), both indexed like the joints given at construction
+    def set_positions_speeds(self, positions, speeds, num_tries = RETRIES):
+        for protocol, (group_num, members) in self.groups.items():
+            # skip the packet when no joint's register mirror changed
+            changed = False
+            for i, joint in members:
+                joint.stage(ADDR_GOAL_POSITION, 2, joint.rad2value(positions[i]))
+                joint.stage(ADDR_MOVING_SPEED, 2, joint.speed2value(speeds[i]))
+                changed = changed or joint.is_dirty(ADDR_GOAL_POSITION) or joint.is_dirty(ADDR_MOVING_SPEED)
+            if not changed:
+                continue
+            for i, joint in members:
+                dxl.groupSyncWriteAddParam(group_num, joint.id, joint.goal_param(positions[i], speeds[i]), LEN_GOAL_POS_SPEED)
+            retry = 0
+            while(retry < num_tries):
+                dxl.groupSyncWriteTxPacket(group_num)
+                dcomm_result = dxl.getLastTxRxResult(self.port, protocol)
+                if dcomm_result != 0:
+                    print_v(dxl.getTxRxResult(protocol, dcomm_result))
+                    retry +=1
+                else:
+                    break
+            dxl.groupSyncWriteClearParam(group_num)
+            if(retry == num_tries):
+                raise Exception("set_positions_speeds failed after {} tries".format(num_tries))
+            for i, joint in members:
+                joint.commit(ADDR_GOAL_POSITION)
+                joint.commit(ADDR_MOVING_SPEED)
+        return 0
+
+class DXL_BULK_READ:
+    """
+    Feedback engine for a chain of joints.  Reads the contiguous block from
+    PRESENT_POSITION through MOVING of every joint and decodes it with the
+    joint's decode_feedback().  MX servos are read together with one bulk
+    read, XL servos with one sync read; AX servos support neither and fall
+    back to one block read each.
+    """
+    def __init__(self, port, joints):
+        self.port = port
+        self.joints = joints
+        self.bulk_group = None
+        self.bulk_members = []
+        self.sync_group = None
+        self.sync_members = []
+        self.single_members = []
+        for i,joint in enumerate(joints):
+            if(joint.type == "MX"):
+                if self.bulk_group is None:
+                    self.bulk_group = dxl.groupBulkRead(port, joint.protocol)
+                dxl.groupBulkReadAddParam(self.bulk_group, joint.id, joint.fb_addr, joint.fb_len)
+                self.bulk_members.append((i, joint))
+            elif(joint.type == "XL"):
+                if self.sync_group is None:
+                    self.sync_group = dxl.groupSyncRead(port, joint.protocol, joint.fb_addr, joint.fb_len)
+                dxl.groupSyncReadAddParam(self.sync_group, joint.id)
+                self.sync_members.append((i, joint))
+            else:
+                self.single_members.append((i, joint))
+
+    # read() returns a list of (position, speed, load, temp, moving) tuples
+    # indexed like the joints given at construction
+    def read(self, num_tries = RETRIES):
+        feedback = [None] * len(self.joints)
+        if self.bulk_group is not None:
+            self.read_group(self.bulk_group, self.bulk_members, feedback,
+                dxl.groupBulkReadTxRxPacket, dxl.groupBulkReadIsAvailable, dxl.groupBulkReadGetData, num_tries)
+        if self.sync_group is not None:
+            self.read_group(self.sync_group, self.sync_members, feedback,
+                dxl.groupSyncReadTxRxPacket, dxl.groupSyncReadIsAvailable, dxl.groupSyncReadGetData, num_tries)
+        for i, joint in self.single_members:
+            feedback[i] = joint.get_feedback(num_tries)
+        return feedback
+
+    def read_group(self, group_num, members, feedback, txrx, is_available, get_data, num_tries):
+        protocol = members[0][1].protocol
+        retry = 0
+        while(retry < num_tries):
+            txrx(group_num)
+            dcomm_result = dxl.getLastTxRxResult(self.port, protocol)
+            if dcomm_result != 0:
+                print_v(dxl.getTxRxResult(protocol, dcomm_result))
+                retry +=1
+            elif not all(is_available(group_num, joint.id, joint.fb_addr, joint.fb_len) for i, joint in members):
+                print_v("bulk read: missing data")
+                retry +=1
+            else:
+                for i, joint in members:
+                    feedback[i] = joint.decode_feedback(lambda addr, length, joint=joint:
+                        get_data(group_num, joint.id, addr, length))
+                return
+        raise Exception("read_group failed after {} tries".format(num_tries))
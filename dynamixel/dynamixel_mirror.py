@@ -0,0 +1,66 @@
+import dynamixel_functions as dxl
+
+"""
+RAM register mirror shared by DXL_MX, DXL_AX and DXL_XL.  It keeps the last
+value written per register address and the staged writes that differ from
+it, so unchanged registers are never sent again.  The servo class provides
+port, id and protocol.
+"""
+
+VERBOSE                  = 0
+RETRIES                  = 30
+
+def print_v(arg):
+    if(VERBOSE):
+        print(arg)
+
+class RegisterMirror:
+    def __init__(self):
+        self.ram = {}
+        self.dirty = {}
+
+    # stage() records a register write; flush() sends the staged writes
+    # whose value differs from the last one written to that register
+    def stage(self, addr, nbytes, value):
+        if(self.ram.get(addr) == value):
+            self.dirty.pop(addr, None)
+        else:
+            self.dirty[addr] = (nbytes, value)
+
+    def flush(self, num_tries = RETRIES):
+        for addr in sorted(self.dirty):
+            nbytes, value = self.dirty[addr]
+            retry = 0
+            while(retry < num_tries):
+                if(nbytes == 1):
+                    dxl.write1ByteTxRx(self.port, self.protocol, self.id, addr, value)
+                else:
+                    dxl.write2ByteTxRx(self.port, self.protocol, self.id, addr, value)
+                dcomm_result = dxl.getLastTxRxResult(self.port, self.protocol)
+                derror = dxl.getLastRxPacketError(self.port, self.protocol)
+                if dcomm_result != 0:
+                    print_v(dxl.getTxRxResult(self.protocol, dcomm_result))
+                    retry +=1
+                elif derror != 0:
+                    print_v(dxl.getRxPacketError(self.protocol, derror))
+                    retry +=1
+                else:
+                    break
+            if(retry == num_tries):
+                raise Exception("write to register {} failed after {} tries".format(addr, num_tries))
+            self.ram[addr] = value
+            del self.dirty[addr]
+        return 0
+
+    def is_dirty(self, addr):
+        return addr in self.dirty
+
+    # commit() marks a staged write as done when it was sent by other
+    # means, e.g. a group sync write
+    def commit(self, addr):
+        if addr in self.dirty:
+            self.ram[addr] = self.dirty.pop(addr)[1]
+
+    # invalidate() forgets the mirror so the next writes always go out
+    def invalidate(self):
+        self.ram = {}
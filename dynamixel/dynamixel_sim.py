@@ -0,0 +1,267 @@
+import time
+import math
+
+"""
+In-process Dynamixel simulator.
+
+SimLib stands in for the ROBOTIS C library loaded by dynamixel_functions.py
+(set DXL_SIM=1 in the environment), so DXL_MX, DXL_AX, DXL_XL, DXL_BUS and
+the group read/write classes run unchanged without hardware.  Each servo
+keeps a control table, tracks its goal position at the commanded moving
+speed, and every transaction is charged a latency from a simple serial
+model so bus-bound throughput can be measured.
+"""
+
+COMM_SUCCESS             = 0
+
+# Register layout and motion parameters per model
+MODELS = {
+    "MX": dict(protocol = 1, resolution = 4095, span = 2*math.pi, max_speed = 12.2595,
+               cw_limit = 6, ccw_limit = 8, torque_enable = 24, goal_position = 30,
+               moving_speed = 32, torque_limit = 34, present_position = 36,
+               present_speed = 38, present_load = 40, present_voltage = 42,
+               present_temp = 43, moving = 46),
+    "AX": dict(protocol = 1, resolution = 1023, span = math.radians(300), max_speed = 11.89,
+               cw_limit = 6, ccw_limit = 8, torque_enable = 24, goal_position = 30,
+               moving_speed = 32, torque_limit = 34, present_position = 36,
+               present_speed = 38, present_load = 40, present_voltage = 42,
+               present_temp = 43, moving = 46),
+    "XL": dict(protocol = 2, resolution = 1023, span = math.radians(300), max_speed = 11.89,
+               cw_limit = 6, ccw_limit = 8, torque_enable = 24, goal_position = 30,
+               moving_speed = 32, torque_limit = 35, present_position = 37,
+               present_speed = 39, present_load = 41, present_voltage = 45,
+               present_temp = 46, moving = 49),
+}
+
+# Servo ids as wired in control_station.py; unknown ids are created on
+# first access, as XL for protocol 2 and MX otherwise
+SIM_LAYOUT = {1:"MX", 2:"MX", 3:"MX", 4:"AX", 5:"AX", 6:"XL", 7:"XL"}
+
+class SimServo:
+    def __init__(self, id, model, speed_limit = None):
+        self.id = id
+        self.model = model
+        self.p = MODELS[model]
+        # speed_limit caps the physical speed in rad/s below the rated max
+        self.speed_limit = speed_limit or self.p["max_speed"]
+        self.registers = bytearray(64)
+        self.write(self.p["ccw_limit"], 2, self.p["resolution"])
+        self.write(self.p["torque_limit"], 2, 1023)
+        self.write(self.p["present_voltage"], 1, 120)
+        self.write(self.p["present_temp"], 1, 35)
+        self.position = self.p["resolution"]/2.0
+        self.write(self.p["goal_position"], 2, int(self.position))
+        self.last_update = time.time()
+
+    def read(self, addr, length):
+        value = 0
+        for i in range(length):
+            value |= self.registers[addr+i] << (8*i)
+        return value
+
+    def write(self, addr, length, value):
+        for i in range(length):
+            self.registers[addr+i] = (int(value) >> (8*i)) & 0xFF
+
+    def update(self, now):
+        """ Move present position toward goal at the commanded speed """
+        p = self.p
+        dt = now - self.last_update
+        self.last_update = now
+        goal = self.read(p["goal_position"], 2)
+        speed_value = self.read(p["moving_speed"], 2) & 1023
+        # a moving speed of 0 means "as fast as possible"
+        speed = p["max_speed"] if speed_value == 0 else speed_value*p["max_speed"]/1023.0
+        # a lowered torque limit slows the servo down proportionally
+        speed = min(speed, self.speed_limit)*self.read(p["torque_limit"], 2)/1023.0
+        step = speed*dt*p["resolution"]/p["span"]
+        error = goal - self.position
+        moving = self.read(p["torque_enable"], 1) and abs(error) > 0.5
+        if(moving):
+            self.position += max(-step, min(step, error))
+        direction = 1024 if error > 0 else 0
+        speed_fb = int(speed_value) if moving else 0
+        self.write(p["present_position"], 2, int(round(self.position)))
+        self.write(p["present_speed"], 2, speed_fb | direction)
+        self.write(p["present_load"], 2, (speed_fb//4) | direction)
+        self.write(p["moving"], 1, 1 if moving else 0)
+
+class SimLib:
+    """
+    Drop-in replacement for the functions bound in dynamixel_functions.py.
+    Only the calls used in this repo are implemented; looking up any other
+    raises AttributeError.
+
+    latency is the fixed turnaround per transaction in seconds, on top of
+    10 bit times per byte at the configured baud rate.  With realtime set
+    the caller sleeps for that long, otherwise it is only accounted in
+    stats.
+    """
+    def __init__(self, latency = 0.0005, realtime = True, layout = SIM_LAYOUT):
+        self.latency = latency
+        self.realtime = realtime
+        self.layout = dict(layout)
+        self.baud = 1000000
+        self.servos = {}
+        self.groups = []
+        self.last_result = COMM_SUCCESS
+        self.data_read = 0
+        self.reset_stats()
+
+    def __getattr__(self, name):
+        raise AttributeError("dynamixel_sim: {} is not simulated".format(name))
+
+    def reset_stats(self):
+        self.stats = dict(transactions = 0, bytes = 0, bus_time = 0.0)
+
+    def add_servo(self, id, model, speed_limit = None):
+        self.servos[id] = SimServo(id, model, speed_limit)
+        return self.servos[id]
+
+    def servo(self, protocol, id):
+        if id not in self.servos:
+            model = self.layout.get(id, "XL" if protocol == 2 else "MX")
+            self.add_servo(id, model)
+        servo = self.servos[id]
+        servo.update(time.time())
+        return servo
+
+    def transaction(self, nbytes):
+        """ Charge one packet exchange of nbytes to the bus """
+        cost = self.latency + nbytes*10.0/self.baud
+        self.stats["transactions"] += 1
+        self.stats["bytes"] += nbytes
+        self.stats["bus_time"] += cost
+        if(self.realtime):
+            time.sleep(cost)
+        self.last_result = COMM_SUCCESS
+
+    # port_handler / packet_handler
+    def portHandler(self, device):
+        return 0
+
+    def packetHandler(self):
+        pass
+
+    def openPort(self, port):
+        return True
+
+    def closePort(self, port):
+        pass
+
+    def setBaudRate(self, port, baud):
+        self.baud = baud
+        return True
+
+    def getLastTxRxResult(self, port, protocol):
+        return self.last_result
+
+    def getTxRxResult(self, protocol, result):
+        return "[TxRxResult] {}".format(result)
+
+    def getRxPacketError(self, protocol, error):
+        return "[RxPacketError] {}".format(error)
+
+    def getLastRxPacketError(self, port, protocol):
+        return 0
+
+    # single register access: 8 byte instruction + 6 byte status + data
+    def readTxRx(self, port, protocol, id, addr, length):
+        servo = self.servo(protocol, id)
+        self.transaction(14 + length)
+        self.data_read = servo.registers[addr:addr+length]
+
+    def getDataRead(self, port, protocol, length, pos):
+        value = 0
+        for i in range(length):
+            value |= self.data_read[pos+i] << (8*i)
+        return value
+
+    def read1ByteTxRx(self, port, protocol, id, addr):
+        self.transaction(15)
+        return self.servo(protocol, id).read(addr, 1)
+
+    def read2ByteTxRx(self, port, protocol, id, addr):
+        self.transaction(16)
+        return self.servo(protocol, id).read(addr, 2)
+
+    def write1ByteTxRx(self, port, protocol, id, addr, value):
+        self.transaction(14)
+        self.servo(protocol, id).write(addr, 1, value)
+
+    def write2ByteTxRx(self, port, protocol, id, addr, value):
+        self.transaction(15)
+        self.servo(protocol, id).write(addr, 2, value)
+
+    def write1ByteTxOnly(self, port, protocol, id, addr, value):
+        self.transaction(8)
+        self.servo(protocol, id).write(addr, 1, value)
+
+    def write2ByteTxOnly(self, port, protocol, id, addr, value):
+        self.transaction(9)
+        self.servo(protocol, id).write(addr, 2, value)
+
+    # group_sync_write: one packet, no status
+    def groupSyncWrite(self, port, protocol, addr, length):
+        self.groups.append(dict(protocol = protocol, addr = addr, length = length, params = {}))
+        return len(self.groups) - 1
+
+    def groupSyncWriteAddParam(self, group_num, id, data, length):
+        self.groups[group_num]["params"][id] = data
+        return True
+
+    def groupSyncWriteClearParam(self, group_num):
+        self.groups[group_num]["params"] = {}
+
+    def groupSyncWriteTxPacket(self, group_num):
+        g = self.groups[group_num]
+        self.transaction(8 + len(g["params"])*(1 + g["length"]))
+        for id, data in g["params"].items():
+            self.servo(g["protocol"], id).write(g["addr"], g["length"], data)
+
+    # group_bulk_read: one instruction, one status packet per servo
+    def groupBulkRead(self, port, protocol):
+        self.groups.append(dict(protocol = protocol, params = {}, data = {}))
+        return len(self.groups) - 1
+
+    def groupBulkReadAddParam(self, group_num, id, addr, length):
+        self.groups[group_num]["params"][id] = (addr, length)
+        return True
+
+    def groupBulkReadTxRxPacket(self, group_num):
+        g = self.groups[group_num]
+        nbytes = 7 + 3*len(g["params"])
+        for id, (addr, length) in g["params"].items():
+            servo = self.servo(g["protocol"], id)
+            g["data"][id] = (addr, servo.registers[addr:addr+length])
+            nbytes += 6 + length
+        self.transaction(nbytes)
+
+    def groupBulkReadIsAvailable(self, group_num, id, addr, length):
+        start, data = self.groups[group_num]["data"].get(id, (0, b""))
+        return addr >= start and addr + length <= start + len(data)
+
+    def groupBulkReadGetData(self, group_num, id, addr, length):
+        start, data = self.groups[group_num]["data"][id]
+        value = 0
+        for i in range(length):
+            value |= data[addr - start + i] << (8*i)
+        return value
+
+    # group_sync_read: same register block from every servo
+    def groupSyncRead(self, port, protocol, addr, length):
+        self.groups.append(dict(protocol = protocol, addr = addr, length = length, params = {}, data = {}))
+        return len(self.groups) - 1
+
+    def groupSyncReadAddParam(self, group_num, id):
+        self.groups[group_num]["params"][id] = (self.groups[group_num]["addr"], self.groups[group_num]["length"])
+        return True
+
+    def groupSyncReadTxRxPacket(self, group_num):
+        self.groupBulkReadTxRxPacket(group_num)
+
+    def groupSyncReadIsAvailable(self, group_num, id, addr, length):
+        return self.groupBulkReadIsAvailable(group_num, id, addr, length)
+
+    def groupSyncReadGetData(self, group_num, id, addr, length):
+        return self.groupBulkReadGetData(group_num, id, addr, length)
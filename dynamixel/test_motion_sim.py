@@ -0,0 +1,143 @@
+import os
+import time
+import types
+import numpy as np
+import pytest
+os.environ["DXL_SIM"] = "1"                  # use the in-process simulator
+HERE = os.path.dirname(os.path.abspath(__file__))
+os.sys.path[:0] = [HERE, os.path.dirname(HERE)]
+from dynamixel_XL import *
+from dynamixel_AX import *
+from dynamixel_MX import *
+from dynamixel_bus import *
+from dynamixel_group import *
+from rexarm import Rexarm
+from trajectory_planner import TrajectoryPlanner
+import state_machine
+import kinect
+from state_machine import StateMachine
+import kinematics as kine
+
+"""
+Pick-and-place motion on the simulated bus, checked through the feedback
+the state machine sees. Run from the repo root:
+    python -m pytest dynamixel/test_motion_sim.py
+"""
+
+BAUDRATE   = 1000000
+DEVICENAME = "/dev/ttyACM0".encode('utf-8')
+
+IDLE = [0.0, 0, 0.0, 0.0, -np.pi/4, 0]
+
+@pytest.fixture(scope="module")
+def port_num():
+    dxlbus = DXL_BUS(DEVICENAME, BAUDRATE)
+    yield dxlbus.port()
+    dxlbus.close()
+
+@pytest.fixture
+def sm(port_num):
+    base = DXL_MX(port_num, 1)
+    shld = DXL_MX(port_num, 2)
+    elbw = DXL_MX(port_num, 3)
+    wrst = DXL_AX(port_num, 4)
+    wrst2 = DXL_AX(port_num, 5)
+    wrst3 = DXL_XL(port_num, 7)
+    grip = DXL_XL(port_num, 6)
+    joints = (base,shld,elbw,wrst,wrst2,wrst3)
+    rexarm = Rexarm(joints, grip, sync_write = DXL_SYNC_WRITE(port_num, joints),
+                    bulk_read = DXL_BULK_READ(port_num, joints))
+    rexarm.initialize()
+    # the simulator slows a servo down with its torque limit
+    rexarm.set_torque_limits([1.0]*rexarm.num_joints)
+    tp = TrajectoryPlanner(rexarm, None)
+    sm = StateMachine(rexarm, tp, None)
+    assert sm.execute_movement([([IDLE], 1)])
+    return sm
+
+def test_descent_follows_line(sm, monkeypatch):
+    """ A fast approach followed by a straight descent stays on the vertical line """
+    pose1 = [150.0, 100.0, 60.0]
+    pose2 = [150.0, 100.0, 25.0]
+    # joint feedback seen by the state machine, tagged with the plan being run
+    trace = []
+    plan = [0]
+    execute_stream = sm.tp.execute_stream
+    def tagged_stream(samples, look_ahead = None):
+        plan[0] += 1
+        return execute_stream(samples, look_ahead)
+    get_feedback = sm.rexarm.get_feedback
+    def recorded_feedback():
+        feedback = get_feedback()
+        trace.append((plan[0], feedback.positions))
+        return feedback
+    monkeypatch.setattr(sm.tp, "execute_stream", tagged_stream)
+    monkeypatch.setattr(sm.rexarm, "get_feedback", recorded_feedback)
+
+    assert sm.execute_movement([(kine.IK(pose1), 1), (kine.IK(pose2), 0.2, pose2)])
+    assert plan[0] == 2
+
+    points = np.array([sm.tp.start_pose(q)[0:3] for k, q in trace if k == 2])
+    a = np.array(pose1)
+    u = (np.array(pose2) - a)/np.linalg.norm(np.array(pose2) - a)
+    d = points - a
+    lateral = np.linalg.norm(d - np.outer(d.dot(u), u), axis=1)
+    assert lateral.max() < 3.0
+    assert np.linalg.norm(points[-1] - pose2) < 3.0
+
+class FakeFrame:
+    def __init__(self, depth):
+        self.depth = depth
+
+    def release(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+class FakeKinect:
+    """ Blocks on a flat board, the depth frame holding heights in mm """
+    def __init__(self, pixels, height):
+        self.currentDepthFrame = np.full((480, 640), height, np.float32)
+        self.depth_model = self
+        self.blocks = np.zeros(len(pixels), kinect.BLOCK_DTYPE)
+        self.blocks['pixel'] = pixels
+
+    def height_at(self, depth, x, y):
+        h = depth[np.asarray(y, int), np.asarray(x, int)]
+        return float(h) if np.ndim(h) == 0 else h
+
+    def latest_frame(self):
+        return FakeFrame(self.currentDepthFrame)
+
+    def detectBlocksInDepthImage(self, frame):
+        return self.blocks
+
+    def blockDetector(self, frame):
+        pass
+
+def test_task1_reuses_drop_plans(sm, monkeypatch):
+    """ The second block of task 1 reuses the moves between idle and above the drop point """
+    monkeypatch.setattr(state_machine, "calibration_done", True)
+    # 6 pixels to the cm, the drop point (320, 330) 150 mm from the base
+    monkeypatch.setattr(state_machine, "affine_matrix_rgb", np.diag([1/6.0, 1/6.0, 1.0]))
+    monkeypatch.setattr(state_machine, "pixel_center", np.array([320, 240]))
+    # no operator to wait for
+    monkeypatch.setattr(state_machine, "time", types.SimpleNamespace(time = time.time, sleep = lambda s: None))
+    sm.kinect = FakeKinect([[440, 240], [320, 132]], 0.0)
+    # a block let go above the drop point (320, 330) stacks on it
+    open_gripper = sm.rexarm.open_gripper
+    def stacking_open_gripper():
+        open_gripper()
+        if np.linalg.norm(sm.tp.start_pose(sm.rexarm.get_positions())[0:2] - [0, -150]) < 10:
+            sm.kinect.currentDepthFrame[320:341, 310:331] += 38
+    monkeypatch.setattr(sm.rexarm, "open_gripper", stacking_open_gripper)
+
+    hits = sm.tp.plan_cache_hits
+    sm.task1()
+    assert sm.kinect.currentDepthFrame[330, 320] == 76
+    # idle to above the drop point and back
+    assert sm.tp.plan_cache_hits - hits == 2
@@ -1,8 +1,178 @@
 import cv2
+import time
+import threading
 import numpy as np
 from PyQt4.QtGui import QImage
 import freenect
 
+""" Bands of the 8 bit depth (raw >> 2) for stacks of one to five blocks """
+STACK_BANDS = np.array([[175,177],[170,175],[165,170],[160,165],[150,160]])
+# 1 + index of the band of every depth value, 0 for none; the lower stack
+# wins where two bands share a value
+STACK_BAND_LUT = np.zeros(256, np.uint8)
+for i in reversed(range(len(STACK_BANDS))):
+    STACK_BAND_LUT[STACK_BANDS[i][0]:STACK_BANDS[i][1]+1] = i + 1
+
+""" Pixel count range of a block top seen by the depth camera (contour area
+400 to 900, the range the blocks were tuned on, plus half the boundary) """
+BLOCK_AREA = (440, 960)
+
+""" Blocks kept per detection, and the record of one block """
+MAX_BLOCKS = 64
+BLOCK_DTYPE = np.dtype([
+    ('pixel', np.float32, 2),       # centroid in the (registered) frame, pixels
+    ('world', np.float32, 3),       # x, y, z of the block top, mm, base frame
+    ('angle', np.float32),          # orientation of the block top, rad
+    ('level', np.int8),             # stack height in blocks
+    ('color', np.int8),             # index into COLOR_ORDER, -1 for none
+    ('confidence', np.float32)])    # fraction of the color patch agreeing
+
+""" Raw depth values covered by the depth model (11 bits) """
+DEPTH_RAW_RANGE = 2048
+""" Distance of the camera from the board in mm """
+CAMERA_HEIGHT = 950.0
+
+class DepthModel():
+    """
+    Raw Kinect depth to height above the board. The analytical fit
+    12.36*tan(raw/2842.5 + 1.1863) (cm from the camera) is evaluated once
+    for every raw value, so a pixel, a region or a whole frame converts
+    with an array index. Raw values past the pole of the fit, including
+    2047 (no reading), map to nan.
+    """
+    def __init__(self, camera_height = CAMERA_HEIGHT):
+        arg = np.arange(DEPTH_RAW_RANGE)/2842.5 + 1.1863
+        distance = 123.6*np.tan(arg)
+        distance[arg >= np.pi/2] = np.nan
+        self.height = (camera_height - distance).astype(np.float32)
+
+    def height_at(self, depth, x, y):
+        """ Height in mm of pixel x,y of a depth frame, x and y may be arrays """
+        h = self.height[np.minimum(depth[np.asarray(y, int), np.asarray(x, int)], DEPTH_RAW_RANGE - 1)]
+        return float(h) if np.ndim(h) == 0 else h
+
+    def height_map(self, depth, out = None):
+        """ Height in mm of every pixel of a depth frame, written to out if given """
+        if(out is None):
+            out = np.empty(depth.shape, np.float32)
+        return np.take(self.height, depth, out=out, mode='clip')
+
+""" Block colors and their LAB ranges (of the frame converted with COLOR_BGR2LAB) """
+COLOR_ORDER = ['yellow','orange','pink','black','blue','green','purple','red']
+COLOR_LOWER = np.array([[220,70,100],[70,148,40],[95,160,60],[30,126,110],[100,140,130],[130,110,125],[85,140,106],[55,159,57]])
+COLOR_HIGHER = np.array([[255,136,136],[130,180,66],[160,200,90],[110,140,135],[155,164,152],[153,120,141],[135,165,125],[110,183,79]])
+""" Bins per LAB channel of the color lookup cube """
+LAB_BINS = 32
+""" Half size in pixels of the square patch sampled at each block center """
+PATCH_RADIUS = 4
+
+class ColorClassifier():
+    """
+    Block color from a LAB lookup cube. Every bin of a LAB_BINS^3 cube
+    holds the index into COLOR_ORDER of the first range containing the
+    bin center, -1 for none. classify() takes the median LAB of a patch
+    around each block center and looks all blocks up at once.
+    """
+    def __init__(self, lower = COLOR_LOWER, higher = COLOR_HIGHER, bins = LAB_BINS):
+        self.shift = int(np.log2(256 // bins))
+        centers = (np.arange(bins) << self.shift) + (1 << self.shift)//2
+        L, A, B = np.meshgrid(centers, centers, centers, indexing='ij')
+        lab = np.stack([L, A, B], axis=-1)
+        self.lut = np.full((bins,)*3, -1, np.int8)
+        for j in reversed(range(len(lower))):
+            inside = np.all((lab >= lower[j]) & (lab <= higher[j]), axis=-1)
+            self.lut[inside] = j
+
+    def lookup(self, lab):
+        """ Color index of LAB values (..., 3) """
+        lab = np.asarray(lab, np.uint8) >> self.shift
+        return self.lut[lab[...,0], lab[...,1], lab[...,2]]
+
+    def classify(self, img, centers, radius = PATCH_RADIUS):
+        """
+        Color index of each block and the fraction of its patch agreeing
+        with it, for centers (N, 2) in pixels of the RGB frame img
+        """
+        centers = np.asarray(centers).reshape(-1, 2)
+        if(len(centers) == 0):
+            return np.zeros(0, np.int8), np.zeros(0)
+        offsets = np.arange(-radius, radius + 1)
+        xs = np.clip(np.round(centers[:,0]).astype(int)[:,None,None] + offsets[None,None,:], 0, img.shape[1] - 1)
+        ys = np.clip(np.round(centers[:,1]).astype(int)[:,None,None] + offsets[None,:,None], 0, img.shape[0] - 1)
+        patches = np.ascontiguousarray(img[ys, xs].reshape(1, -1, 3))
+        # only the patches are converted, with the conversion the ranges were tuned on
+        lab = cv2.cvtColor(patches, cv2.COLOR_BGR2LAB).reshape(len(centers), -1, 3)
+        ids = self.lookup(np.median(lab, axis=1))
+        confidence = np.mean(self.lookup(lab) == ids[:,None], axis=1)
+        return ids, confidence
+
+""" Frame pairs kept by the capture ring buffer """
+RING_SIZE = 4
+
+class FrameRing():
+    """
+    Fixed set of preallocated, timestamped RGB + depth frame pairs. The
+    capture thread fills the slots round robin and readers pin the newest
+    complete pair with latest(). A pinned slot is never written, so a
+    reader sees one consistent pair however long it holds it, while
+    capture carries on in the other slots.
+    """
+    def __init__(self, size = RING_SIZE, shape = (480,640)):
+        self.video = np.zeros((size,)+shape+(3,), np.uint8)
+        self.depth = np.zeros((size,)+shape, np.uint16)
+        self.stamp = np.zeros(size)
+        self.pins = [0]*size
+        self.lock = threading.Lock()
+        self.newest = -1
+        self.next = 0
+
+    def claim(self):
+        """ Slot for the next capture, None when every other slot is pinned """
+        with self.lock:
+            for i in range(len(self.pins)):
+                slot = (self.next + i) % len(self.pins)
+                if(self.pins[slot] == 0 and slot != self.newest):
+                    self.next = slot + 1
+                    return slot
+            return None
+
+    def publish(self, slot, stamp):
+        with self.lock:
+            self.stamp[slot] = stamp
+            self.newest = slot
+
+    def latest(self):
+        """ Pin the newest pair, None before the first capture """
+        with self.lock:
+            if(self.newest < 0):
+                return None
+            self.pins[self.newest] += 1
+            return FrameHandle(self, self.newest)
+
+    def release(self, slot):
+        with self.lock:
+            self.pins[slot] -= 1
+
+class FrameHandle():
+    """ A pinned RGB + depth pair, release() it or use it in a with block """
+    def __init__(self, ring, slot):
+        self.ring = ring
+        self.slot = slot
+        self.video = ring.video[slot]
+        self.depth = ring.depth[slot]
+        self.stamp = ring.stamp[slot]
+
+    def release(self):
+        if(self.ring is not None):
+            self.ring.release(self.slot)
+            self.ring = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
 class Kinect():
     def __init__(self):
         self.currentVideoFrame = np.array([])
@@ -12,49 +182,104 @@ class Kinect():
         else:
             self.kinectConnected = True
 
+        # capture ring buffer, filled by the thread from start_capture()
+        self.ring = FrameRing()
+        self.capturing = False
+
         # mouse clicks & calibration variables
         self.depth2rgb_affine = np.float32([[1,0,0],[0,1,0]])
+        # depth pixel read by every registered pixel, built from depth2rgb_affine,
+        # and an optional (x, y, w, h) region the registration is limited to
+        self.registration_map = None
+        self.registration_roi = None
         self.kinectCalibrated = False
         self.last_click = np.array([0,0])
         self.new_click = False
         self.rgb_click_points = np.zeros((5,2),int)
         self.depth_click_points = np.zeros((5,2),int)
 
-        """ Extra arrays for colormaping the depth image"""
-        self.DepthHSV = np.zeros((480,640,3)).astype(np.uint8)
-        self.DepthCM=np.array([])
+        """ Display buffers, two of each so Qt can still read one while the next is drawn """
+        self.VideoDisplay = np.zeros((2,480,640,3), np.uint8)
+        self.DepthCM = np.zeros((2,480,640,3), np.uint8)
+        self.display_index = 0
+        """ Depth colormap: fixed saturation and value, so RGB only depends on the low 8 bits """
+        hsv = np.zeros((1,256,3), np.uint8)
+        hsv[0,:,0] = np.arange(256)
+        hsv[0,:,1] = 0x9F
+        hsv[0,:,2] = 0xFF
+        self.DepthLUT = cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB)[0]
+
+        """ Depth conversion, and the height map of the last frame passed to heightMap() """
+        self.depth_model = DepthModel()
+        self.HeightMap = np.zeros((480,640), np.float32)
+        self.color_classifier = ColorClassifier()
 
         """ block info """
         self.block_contours = np.array([])
-        self.block_coordinates=np.array([])
-
-    def captureVideoFrame(self):
+        # blocks is a view of the first detected records of BlockBuffer
+        self.BlockBuffer = np.zeros(MAX_BLOCKS, BLOCK_DTYPE)
+        self.blocks = self.BlockBuffer[:0]
+
+    def start_capture(self):
+        """ Capture frame pairs into the ring buffer on a thread of its own """
+        self.capturing = True
+        thread = threading.Thread(target=self.capture_loop)
+        thread.daemon = True
+        thread.start()
+
+    def stop_capture(self):
+        self.capturing = False
+
+    def capture_loop(self):
+        while(self.capturing):
+            if(not self.capture()):
+                time.sleep(0.005)
+            if(not self.kinectConnected):
+                # the file frames never change, no need to spin
+                time.sleep(0.03)
+
+    def capture(self):
         """
-        Capture frame from Kinect, format is 24bit RGB
+        Capture one RGB + depth pair into a free ring slot and make it the
+        newest; False if every slot is pinned. Read it through
+        latest_frame(), the slot is refilled once it is no longer pinned.
         """
+        slot = self.ring.claim()
+        if(slot is None):
+            return False
+        video = self.ring.video[slot]
+        depth = self.ring.depth[slot]
         if(self.kinectConnected):
-            self.currentVideoFrame = freenect.sync_get_video()[0]
+            np.copyto(video, freenect.sync_get_video()[0])
+            if(self.kinectCalibrated):
+                self.registerDepthFrame(freenect.sync_get_depth()[0], depth)
+            else:
+                np.copyto(depth, freenect.sync_get_depth()[0])
         else:
             self.loadVideoFrame()
-        self.processVideoFrame()
-
-
-    def processVideoFrame(self):
-        cv2.drawContours(self.currentVideoFrame,self.block_contours,-1,(0,0,0),3)
+            self.loadDepthFrame()
+            np.copyto(video, self.currentVideoFrame)
+            np.copyto(depth, self.currentDepthFrame)
+        self.ring.publish(slot, time.time())
+        return True
 
+    def latest_frame(self):
+        """ Pinned newest RGB + depth pair (a FrameHandle), None before the first capture """
+        return self.ring.latest()
 
-    def captureDepthFrame(self):
+    def heightMap(self, frame = None):
         """
-        Capture depth frame from Kinect, format is 16bit Grey, 10bit resolution.
+        Height above the board in mm of every pixel of the depth frame of
+        the pinned pair, the newest one if not given (None before the first
+        capture). Written into the persistent HeightMap buffer.
         """
-        if(self.kinectConnected):
-            if(self.kinectCalibrated):
-                self.currentDepthFrame = self.registerDepthFrame(freenect.sync_get_depth()[0])
-            else:
-                self.currentDepthFrame = freenect.sync_get_depth()[0]
-        else:
-            self.loadDepthFrame()
-
+        if(frame is None):
+            frame = self.latest_frame()
+            if(frame is None):
+                return None
+            with frame:
+                return self.heightMap(frame)
+        return self.depth_model.height_map(frame.depth, self.HeightMap)
 
     def loadVideoFrame(self):
         self.currentVideoFrame = cv2.cvtColor(
@@ -65,36 +290,46 @@ class Kinect():
     def loadDepthFrame(self):
         self.currentDepthFrame = cv2.imread("data/ex0_depth16.png",0)
 
-    def convertFrame(self):
-        """ Converts frame to format suitable for Qt  """
+    def display_buffer(self, buffers):
+        self.display_index ^= 1
+        return buffers[self.display_index]
+
+    def convertFrame(self, frame):
+        """ Converts frame to format suitable for Qt
+            The QImage wraps a persistent display buffer without copying it
+        """
         try:
-            img = QImage(self.currentVideoFrame,
-                             self.currentVideoFrame.shape[1],
-                             self.currentVideoFrame.shape[0],
+            # the one copy per frame: the ring slot can't be drawn on, blockDetector
+            # reads its colors, and can't be wrapped, it is refilled once released
+            video = self.display_buffer(self.VideoDisplay)
+            np.copyto(video, frame.video)
+            cv2.drawContours(video,self.block_contours,-1,(0,0,0),3)
+            img = QImage(video.data,
+                             video.shape[1],
+                             video.shape[0],
                              QImage.Format_RGB888
                              )
             return img
         except:
             return None
 
-    def convertDepthFrame(self):
+    def convertDepthFrame(self, frame):
         """ Converts frame to a colormaped format suitable for Qt
             Note: this cycles the spectrum over the lowest 8 bits
         """
         try:
 
             """
-            Convert Depth frame to rudimentary colormap
+            Convert Depth frame to rudimentary colormap, one table lookup per pixel
             """
-            self.DepthHSV[...,0] = self.currentDepthFrame
-            self.DepthHSV[...,1] = 0x9F
-            self.DepthHSV[...,2] = 0xFF
-            self.DepthCM = cv2.cvtColor(self.DepthHSV,cv2.COLOR_HSV2RGB)
-            cv2.drawContours(self.DepthCM,self.block_contours,-1,(0,0,0),3)
-
-            img = QImage(self.DepthCM,
-                             self.DepthCM.shape[1],
-                             self.DepthCM.shape[0],
+            depth = frame.depth
+            depth_cm = self.display_buffer(self.DepthCM)
+            np.take(self.DepthLUT, np.bitwise_and(depth, 0xFF), axis=0, out=depth_cm)
+            cv2.drawContours(depth_cm,self.block_contours,-1,(0,0,0),3)
+
+            img = QImage(depth_cm.data,
+                             depth_cm.shape[1],
+                             depth_cm.shape[0],
                              QImage.Format_RGB888
                              )
             return img
@@ -113,16 +348,40 @@ class Kinect():
         pts2 = coord2[0:3].astype(np.float32)
         self.depth2rgb_affine = cv2.getAffineTransform(pts1,pts2)
         # print("calcAffine")
+        self.buildRegistration()
         return self.depth2rgb_affine
 
+    def buildRegistration(self):
+        """
+        Tabulate depth2rgb_affine: for every registered pixel the nearest
+        depth pixel it is read from, as a fixed point map for cv2.remap
+        """
+        inverse = cv2.invertAffineTransform(self.depth2rgb_affine)
+        x, y = np.meshgrid(np.arange(640, dtype=np.float32), np.arange(480, dtype=np.float32))
+        map_x = inverse[0,0]*x + inverse[0,1]*y + inverse[0,2]
+        map_y = inverse[1,0]*x + inverse[1,1]*y + inverse[1,2]
+        self.registration_map, _ = cv2.convertMaps(map_x.astype(np.float32), map_y.astype(np.float32),
+                                                   cv2.CV_16SC2, nninterpolation=True)
+
 
-    def registerDepthFrame(self, frame):
+    def registerDepthFrame(self, frame, dst = None):
         """
-        TODO:
-        Using an Affine transformation, transform the depth frame to match the RGB frame
+        Transform the depth frame to match the RGB frame by gathering the
+        nearest depth pixel through the precomputed registration map.
+        Pixels mapping outside the depth frame, or outside
+        registration_roi when one is set, are 0.
         """
-        # print("warpAffine")
-        return cv2.warpAffine(frame,self.depth2rgb_affine,(640,480))
+        if(self.registration_map is None):
+            self.buildRegistration()
+        if(self.registration_roi is None):
+            return cv2.remap(frame, self.registration_map, None, cv2.INTER_NEAREST, dst)
+        x, y, w, h = self.registration_roi
+        if(dst is None):
+            dst = np.zeros((480,640), frame.dtype)
+        else:
+            dst.fill(0)
+        cv2.remap(frame, self.registration_map[y:y+h, x:x+w], None, cv2.INTER_NEAREST, dst[y:y+h, x:x+w])
+        return dst
 
     def loadCameraCalibration(self):
         """
@@ -132,201 +391,70 @@ class Kinect():
 
         pass
 
-    def blockDetector(self):
+    def blockDetector(self, frame):
         """
-        TODO:
-        Implement your block detector here.
-        You will need to locate
-        blocks in 3D space
+        Color of every block found by detectBlocksInDepthImage(), from the
+        RGB frame of the pinned pair. Fills the color and confidence fields
+        of blocks.
         """
+        img = frame.video
+        self.blocks['color'], self.blocks['confidence'] = \
+            self.color_classifier.classify(img, self.blocks['pixel'])
+        return self.blocks
 
-        # Taking the RGB camera as input
-        img = self.currentVideoFrame
-
-        # Converting the Camera frame from RGB to HSV
-        # bgr_frame = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-        cv2.imwrite('test_bgr.png',img)
-        hsv = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
-
-        # Definining the HSV Values
-        color_order=['yellow','orange','pink','black','blue','green','purple','red']
-        color_lower_array=np.array([[220,70,100],[70,148,40],[95,160,60],[30,126,110],[100,140,130],[130,110,125],[85,140,106],[55,159,57]])
-        color_higher_array=np.array([[255,136,136],[130,180,66],[160,200,90],[110,140,135],[155,164,152],[153,120,141],[135,165,125],[110,183,79]])
-
-        # Extracting the H,S and V values at the center of the block in the RGB frame
-        # Creating list to store the detected colors
-        color=[]
-        count=0
-
-        # print(self.block_coordinates.size)
-
-
-        for i in range(self.block_coordinates.size - 2):
-            h = hsv[int(self.block_coordinates[i+count+1])][int(self.block_coordinates[i+count])][0]
-            s = hsv[int(self.block_coordinates[i+count+1])][int(self.block_coordinates[i+count])][1]
-            v = hsv[int(self.block_coordinates[i+count+1])][int(self.block_coordinates[i+count])][2]
-            rgb_hsv_values=np.array([])
-            rgb_hsv_values=np.array([h,s,v])
-            print("HSV value of pixel is",rgb_hsv_values)
-            count=count+1
-
-            color_detected = False
-            for j in range(len(color_order)):
-                # print (rgb_hsv_values[0]>=color_lower_array[int(j)][0])
-                # print (rgb_hsv_values[0]<=color_higher_array[int(j)][0])
-                # print (rgb_hsv_values[1]>=color_lower_array[int(j)][1])
-                # print (rgb_hsv_values[1]<=color_higher_array[int(j)][1])
-                # print (rgb_hsv_values[2]>=color_lower_array[int(j)][2])
-                # print (rgb_hsv_values[2]<=color_higher_array[int(j)][2])
-                
-                if (rgb_hsv_values[0]>=color_lower_array[j][0] and rgb_hsv_values[0]<=color_higher_array[j][0]) and (rgb_hsv_values[1]>=color_lower_array[j][1] and rgb_hsv_values[1]<=color_higher_array[j][1]) and (rgb_hsv_values[2]>=color_lower_array[j][2] and rgb_hsv_values[2]<=color_higher_array[j][2]):
-                    color.append([color_order[j],self.block_coordinates[i+count-1],self.block_coordinates[i+count]])
-                    color_detected = True
-
-            if color_detected == False:
-                color.append(["no color detected",self.block_coordinates[i+count]])
-            # print (color)
-            if(self.block_coordinates.size==count*2):
-                break
-
-            
-            # cv2.setMouseCallback("window",mouse_callback)
-
-        print (color)
-        return
-
-    def detectBlocksInDepthImage(self):
+    def detectBlocksInDepthImage(self, frame):
         """
-        TODO:
-        Implement a blob detector to find blocks
-        in the depth image
+        Find blocks in the depth image in a single pass: the 8 bit depth is
+        quantized into stack height bands with one table lookup, pixels
+        next to a pixel of another non-zero band are dropped so touching
+        stacks split while block outlines against the background stay,
+        and one connected components pass gives the pixel count and
+        centroid of every blob. Blobs of block size get an oriented box
+        from their pixels. Fills the pixel, angle and level fields of
+        blocks, the other fields are zeroed (color -1).
         """
 
-        # Loading the frame from the Kinect Depth Camera
-        depth_frame = self.currentDepthFrame
-        self.block_contours = ([])
+        # Loading the frame from the Kinect Depth Camera, of the pinned pair
+        depth_frame = frame.depth
 
         # Extracting required depth informmation from the appropriate bits
-        np.clip(depth_frame,0,2**10 - 1,depth_frame)
-        depth_frame >>= 2
-        depth_frame = depth_frame.astype(np.uint8)
-
-        # Defining lower and higher limits for thresholding
-        stack_size=['one','two','three','four','five']
-        stack_thresh_lower_array=np.array([[175],[170],[165],[160],[150]])
-        stack_thresh_higher_array=np.array([[177],[175],[170],[165],[160]])
-
-        # Defining np array for storing block coordinates
-        self.block_coordinates=([])
-        block_coordinates=np.array([])
-        int_block_contours = []
-        int_block_coordinates = np.array([])
-        # For each threshold in stack performing the below operations (This is used to detect block stacks up to 5)
-        count = 0
-        countin = 0
-        for i in range(len(stack_thresh_lower_array)):
-            # Thresholding the image
-            mask = cv2.inRange(depth_frame, stack_thresh_lower_array[i], stack_thresh_higher_array[i])
-            # Performing Morphological Operations on image
-            opening = cv2.morphologyEx(mask, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT,(3,3)))
-            closing = cv2.morphologyEx(opening, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT,(3,3)))
-
-            # Detecting the contours
-            im2, contours, hierarchy = cv2.findContours(closing, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)
-
-            # Find the largest contour and ensuring area is within a defined limit
-            contour_sizes = [(cv2.contourArea(contour), contour) for contour in contours if (cv2.contourArea(contour)>400 and cv2.contourArea(contour)<900)]
-            # biggest_contour = max(contour_sizes, key=lambda x: x[0])[1]
-            block_contours = []
-            box_contours = []
-            block_coordinates=np.array([])
-            # print(contours)
-            for contour in contours:
-                if (cv2.contourArea(contour)>400 and cv2.contourArea(contour)<900):
-                    countin +=1
-                    block_contours.append(contour)
-            # print(len(block_contours))
-            # Drawing the largest contour
-
-            # cv2.drawContours(depth_frame, biggest_contour, -1, (255,255,0), 3)
-            print("Threshold is for",stack_size[i])
-            # Drawing a bounding rectangle for the detected box
-            for contour in block_contours:
-                block_coordinates=np.array([])
-                count += 1
-                rect = cv2.minAreaRect(contour)
-                box = cv2.boxPoints(rect)
-                box = np.int0(box)
-                center=rect[0]
-                angle = rect[2]
-                cv2.drawContours(depth_frame,[box],0,(0,0,255),2)
-                box = np.asarray(box)
-                box_contours.append(box)
-
-            # Marking the center of the box
-                depth_frame[int(center[1])-2:int(center[1])+2,int(center[0])-2:int(center[0])+2]=[0]
-
-                # print("depth change \n")
-            # Storing the center coordinates in np array
-
-
-
-                block_coordinates=np.append(block_coordinates,[center[0],center[1]])
-                print("Block coordinates are", block_coordinates)
-                int_block_contours += box_contours
-                # print("Contours are", int_block_contours)
-                int_block_coordinates = np.append(int_block_coordinates,block_coordinates)
-                print("Block coordinates are", int_block_coordinates)
-                print("Length of accumulated block contours is", len(int_block_contours),'b\n')
-                print("Length of accumulated block coords is",int_block_coordinates.size, 'c\n')
-                print("Block ends")
-            # Print Block Height
-            # z = kinect.currentDepthFrame[int(center[1])][int(center[0])]
-            # print("Block height is",z)
-
-            # Determining the rotation matrice
-            # rows, cols = img.shape[:2]
-            # rot = cv.getRotationMatrix2D(center, angle-90, 1)
-            # print(rot)
-            # img = cv.warpAffine(img, rot, (rows,cols))
-
-            # Method 2 for Detecting COM using Moments Method
-
-            # Center of Mass of the detected contour
-            # M = cv.moments(biggest_contour)
-            # print("M is", M )
-
-            # cx = int(M['m10']/M['m00'])
-            # cy = int(M['m01']/M['m00'])
-
-            # # Printing the COM coordinates of the detected object
-            # print ("Cx is ", cx)
-            # print ("Cy is ", cy)
-
-            # # Marking the COMon the image
-            # img[cy-2:cy+2,cx-2:cx+2]=[0,0,255]
-        self.block_contours = int_block_contours
-        self.block_coordinates = int_block_coordinates
-        # print(block_coordinates)
-        cv2.imwrite('test.jpg',depth_frame)
-        # cv2.namedWindow("window",cv2.WINDOW_AUTOSIZE)
-        # cv2.namedWindow("mask",cv2.WINDOW_AUTOSIZE)
-        # cv2.imshow('window', depth_frame)
-        # cv2.imshow('mask', closing)
-
-        # time.sleep(5) # Pausing for 5 seconds
-        # while True:
-        #     ch = 0xFF & cv2.waitKey(10)
-        #     if ch == 0x1B:
-        #         break
-        # cv2.destroyAllWindows()
-
-
-
-        ##############################################################
-
-        # RGB Camera portion of the image
-
-
-        # pass
-        return
\ No newline at end of file
+        # (into a new array, the captured frame is shared)
+        depth_frame = (np.clip(depth_frame,0,2**10 - 1) >> 2).astype(np.uint8)
+
+        # Stack band of every pixel, 0 outside all bands
+        band = cv2.LUT(depth_frame, STACK_BAND_LUT)
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT,(3,3))
+        mask = (band > 0).astype(np.uint8)
+        # a neighbour in a higher band, or in a lower one (the background,
+        # band 0, counted as above all bands so block outlines stay intact)
+        mask[cv2.dilate(band, kernel) != band] = 0
+        mask[cv2.erode(np.where(band > 0, band, 255).astype(np.uint8), kernel) != band] = 0
+        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
+        mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+        n, labels, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=4)
+
+        # Majority band of each blob from one histogram over (label, band)
+        hist = np.bincount((labels*(len(STACK_BANDS)+1) + band).ravel(),
+                           minlength=n*(len(STACK_BANDS)+1)).reshape(n, -1)
+        blob_band = np.argmax(hist[:,1:], axis=1)
+        area = stats[:,cv2.CC_STAT_AREA]
+        keep = np.flatnonzero((area > BLOCK_AREA[0]) & (area < BLOCK_AREA[1]))
+        keep = keep[keep > 0]
+        # blocks of the lowest stacks first, as the per-band passes used to
+        keep = keep[np.argsort(blob_band[keep], kind='stable')][:MAX_BLOCKS]
+
+        blocks = self.BlockBuffer[:len(keep)]
+        blocks.fill(0)
+        blocks['pixel'] = centroids[keep]
+        blocks['level'] = blob_band[keep] + 1
+        blocks['color'] = -1
+        block_contours = []
+        for i, k in enumerate(keep):
+            x, y, w, h = stats[k,0:4]
+            pts = np.argwhere(labels[y:y+h, x:x+w] == k)[:,::-1] + (x, y)
+            rect = cv2.minAreaRect(pts.astype(np.float32))
+            blocks['angle'][i] = np.deg2rad(rect[2])
+            block_contours.append(cv2.boxPoints(rect).astype(np.int32))
+        self.block_contours = block_contours
+        self.blocks = blocks
+        return blocks
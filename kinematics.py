@@ -1,6 +1,7 @@
 import numpy as np
 import sys
 from math import *
+import se3
 
 """ 
 TODO: Here is where you will write all of your kinematics functions 
@@ -8,81 +9,87 @@ There are some functions to start with, you may need to implement a few more
 
 """
 
-def FK_dh(joint_angles,link):
+""" DH table of the Rexarm, distances in mm. Row i is link i+1 """
+DH_A = np.array([0.0, 99.0, 112.0, 109.0])
+DH_ALPHA = np.array([np.pi/2, 0.0, 0.0, 0.0])
+DH_D = np.array([118.0, 0.0, 0.0, 0.0])
+# joint driving each link's theta and its constant offset
+# (joint 3, the wrist rotation, does not move the end effector point)
+DH_JOINT = np.array([0, 1, 2, 4])
+DH_OFFSET = np.array([0.0, np.pi/2, 0.0, 0.0])
+DH_COS_ALPHA = np.cos(DH_ALPHA)
+DH_SIN_ALPHA = np.sin(DH_ALPHA)
+
+def FK_dh(joint_angles,link=4):
     """
 
     Calculate forward kinematics for rexarm using DH convention
-    return a transformation matrix representing the pose of the 
-    desired link
+    return the x,y,z position of the end effector
 
-    note: phi is the euler angle about the y-axis in the base frame
+    note: link is kept for compatibility, use FK_dh_batch to get the
+    full transform of an intermediate link
 
     """
-    # print ("DOING DH")
-
-    base_theta=joint_angles[0]
-    shoulder_theta=joint_angles[1]
-    elbow_theta=joint_angles[2]
-    w1_theta=joint_angles[3]
-    w2_theta=joint_angles[4]
-
-    # Defining DH table parameters  
-
-    # Distances are in mm
-
-    d1=118
-    a2=99
-    a3=112
-    a4=109
-
-    # d1=122.14 
-    # a2=105
-    # a3=126.77
-    # a4=122.12
-
-    a=np.array([0,a2,a3,a4])
-    alpha=np.array([np.pi/2,0,0,0])
-    d=np.array([d1,0,0,0])
-    theta=np.array([base_theta,shoulder_theta+np.pi/2,elbow_theta,w2_theta])
-
-    # Defining functions to compute matrices
-
-    def Trans_z_d (d):
-        return np.array([[1,0,0,0],[0,1,0,0],[0,0,1,d],[0,0,0,1]])
-
-    def Trans_x_a (a):
-        return np.array([[1,0,0,a],[0,1,0,0],[0,0,1,0],[0,0,0,1]])
-
-    def Rot_z_theta (theta):
-        return np.array([[np.cos(theta),-np.sin(theta),0,0],[np.sin(theta),np.cos(theta),0,0],[0,0,1,0],[0,0,0,1]])
-
-    def Rot_x_alpha (alpha):
-        return np.array([[1,0,0,0],[0,np.cos(alpha),-np.sin(alpha),0],[0,np.sin(alpha),np.cos(alpha),0],[0,0,0,1]])
+    return FK_dh_batch(joint_angles)[0,0:3,3]
 
-    # Computing the H matrix 
-    H=np.identity(4)
-    
-    for i in range(4):
-        A=np.matmul(Rot_z_theta(theta[i]),np.matmul(Trans_z_d(d[i]),np.matmul(Trans_x_a(a[i]),Rot_x_alpha(alpha[i]))))
-        H=np.matmul(H,A)
-
-    # Calculating phi as the euler angle about the y-axis in the base frame
-
-    phi=np.array([joint_angles[1]+joint_angles[2]+joint_angles[4]])
-
-    # Extracting the required x,y and z elements from H matrix
-    #print(H)
-    H=H[0:3,-1]
-    #print(H)
-    np.append(H, phi) 
+def FK_dh_batch(joint_angles, link=4, l4=DH_A[3]):
+    """
+    Vectorized forward kinematics using the DH convention
 
+    joint_angles is an (N, 5+) array of joint vectors (a single vector
+    is treated as N=1). Returns an (N, 4, 4) array with the transform of
+    frame `link` (1 to 4, 4 being the end effector) in the base frame.
+    l4 is the length of the last link, e.g. L_GRIP for the grasp point.
+    """
+    a = DH_A.copy()
+    a[3] = l4
+    q = np.atleast_2d(np.asarray(joint_angles, dtype=float))
+    N = q.shape[0]
+    theta = q[:,DH_JOINT[:link]] + DH_OFFSET[:link]
+    ct = np.cos(theta)
+    st = np.sin(theta)
+    H = np.empty((N,4,4))
+    H[:] = np.identity(4)
+    A = np.zeros((N,4,4))
+    A[:,3,3] = 1
+    for i in range(link):
+        # A = Rot_z(theta) Trans_z(d) Trans_x(a) Rot_x(alpha) for all N at once
+        A[:,0,0] = ct[:,i]
+        A[:,0,1] = -st[:,i]*DH_COS_ALPHA[i]
+        A[:,0,2] = st[:,i]*DH_SIN_ALPHA[i]
+        A[:,0,3] = a[i]*ct[:,i]
+        A[:,1,0] = st[:,i]
+        A[:,1,1] = ct[:,i]*DH_COS_ALPHA[i]
+        A[:,1,2] = -ct[:,i]*DH_SIN_ALPHA[i]
+        A[:,1,3] = a[i]*st[:,i]
+        A[:,2,1] = DH_SIN_ALPHA[i]
+        A[:,2,2] = DH_COS_ALPHA[i]
+        A[:,2,3] = DH_D[i]
+        H = np.matmul(H, A)
     return H
-    pass
+
+""" Screw axes (w, v) of the joints in the base frame at the zero pose """
+# all joints except the base turn about -y once the arm stands straight up;
+# joint 3 (wrist rotation) is left out as in the DH table
+POX_JOINT = np.array([0, 1, 2, 4])
+POX_W = np.array([[0.0, 0.0, 1.0],
+                  [0.0, -1.0, 0.0],
+                  [0.0, -1.0, 0.0],
+                  [0.0, -1.0, 0.0]])
+POX_Q = np.array([[0.0, 0.0, 0.0],
+                  [0.0, 0.0, DH_D[0]],
+                  [0.0, 0.0, DH_D[0] + DH_A[1]],
+                  [0.0, 0.0, DH_D[0] + DH_A[1] + DH_A[2]]])
+POX_V = -np.cross(POX_W, POX_Q)
+# note: se3.skew and se3.aaToRot return the transposes of [w] and
+# Rot(w), hence the negated arguments
+POX_SKEW = se3.skew(-POX_W)
+POX_SKEW2 = np.matmul(POX_SKEW, POX_SKEW)
+""" End effector frame at the zero pose """
+POX_M = FK_dh_batch(np.zeros(6))[0]
 
 def FK_pox(joint_angles):
     """
-    TODO: implement this function
-
     Calculate forward kinematics for rexarm
     using product of exponential formulation
 
@@ -92,112 +99,177 @@ def FK_pox(joint_angles):
     note: phi is the euler angle about y in the base frame
 
     """
-    pass
+    return tuple(get_pose_from_T(FK_pox_batch(joint_angles)[0]))
 
-def IK(pose):
+def FK_pox_batch(joint_angles):
     """
-    TODO: implement this function
+    Vectorized product of exponentials forward kinematics
 
-    Calculate inverse kinematics for rexarm
-
-    return the required joint angles
-    """
-    # Inverse Kinematics Equations for Elbow Up Configuration
-    # Extracting the required information from pose
-   # Given link geometry
-    l1=118
-    l2=99
-    l3=112
-    l4=128
-
-    x=pose[0]
-    y=pose[1]
-    z=pose[2]
-
-    # extended distance
-
-    d=sqrt(x**2+y**2)
-    # print('d',d)
-    # print('l23',l2+l3)
-    if d<=l2+l3:
-        # Base angle
-        base_theta = atan2(y,x)
-        #print(base_theta/np.pi*180)
-
-        if z<=l1:
-            zl1=l1-z
-            # elbow angle theta2
-            phi2 = np.arctan2(l4-zl1,d)
-            m1_squared = d**2+(l4-zl1)**2
-            elbow_theta = np.pi-acos((l2**2 + l3**2 - m1_squared)/(2*l2*l3))
-            #print(elbow_theta/np.pi*180)
-        else:
-            zl1=z-l1
-            # elbow angle theta2
-            phi2 = np.arctan2(l4+zl1,d)
-            m1_squared = d**2+(l4+zl1)**2
-            elbow_theta = np.pi-acos((l2**2 + l3**2 - m1_squared)/(2*l2*l3))
-            #print(elbow_theta/np.pi*180)
-
-
-        # shoulder angle theta1
-        phi1 = elbow_theta - acos((m1_squared+l3**2-l2**2)/(2*l3*sqrt(m1_squared)))
-        shoulder_theta = np.pi/2-(phi1+phi2)
-        #print(shoulder_theta/np.pi*180)
-
-        # wrist angle theta3
-        w2_theta = np.pi-(elbow_theta-phi1+np.pi/2-phi2)
-        #print(w2_theta/np.pi*180)
-
-        # print(base_theta,shoulder_theta-np.pi/2,elbow_theta,0,w2_theta)
-        # print("Angle in degrees",base_theta*180/np.pi, shoulder_theta*180/np.pi, elbow_theta*180/np.pi,w2_theta*180/np.pi)
-
-        return [[base_theta,shoulder_theta+np.pi/2,elbow_theta,0,w2_theta,0]]
-        pass
-
-    else:
-        print ("Not reachable")
-        return None
+    joint_angles is an (N, 5+) array of joint vectors. Returns the (N, 4, 4)
+    end effector transforms, equal to FK_dh_batch(joint_angles).
+    """
+    q = np.atleast_2d(np.asarray(joint_angles, dtype=float))
+    N = q.shape[0]
+    T = np.empty((N,4,4))
+    T[:] = np.identity(4)
+    E = np.zeros((N,4,4))
+    E[:,3,3] = 1
+    for i,j in enumerate(POX_JOINT):
+        theta = q[:,j]
+        E[:,:3,:3] = se3.aaToRot(-POX_W[i]*theta[:,np.newaxis])
+        # translation of e^([s]theta) for a revolute joint
+        G = (theta[:,np.newaxis,np.newaxis]*np.identity(3)
+             + (1 - np.cos(theta))[:,np.newaxis,np.newaxis]*POX_SKEW[i]
+             + (theta - np.sin(theta))[:,np.newaxis,np.newaxis]*POX_SKEW2[i])
+        E[:,:3,3] = np.matmul(G, POX_V[i])
+        T = np.matmul(T, E)
+    return np.matmul(T, POX_M)
+
+""" FK backends, all (N, 5+) joint vectors to (N, 4, 4) end effector frames """
+FK_BACKENDS = {"dh": FK_dh_batch, "pox": FK_pox_batch}
+
+def FK_batch(joint_angles, backend="dh"):
+    """ Batch forward kinematics through the selected backend ("dh" or "pox") """
+    return FK_BACKENDS[backend](joint_angles)
+
+def jacobian_batch(joint_angles, l4=DH_A[3]):
+    """
+    Analytic Jacobian of the end effector pose (x, y, z, phi) of FK_dh
+
+    joint_angles is an (N, 5+) array of joint vectors; returns (N, 4, 6)
+    with the derivatives with respect to all six joints (the columns of
+    joints 3 and 5, which do not move the end effector, are zero).
+    """
+    q = np.atleast_2d(np.asarray(joint_angles, dtype=float))
+    N = q.shape[0]
+    a2, a3, a4 = DH_A[1], DH_A[2], l4
+    # link angles above the horizontal in the arm plane
+    t2 = q[:,1] + np.pi/2
+    t3 = t2 + q[:,2]
+    t4 = t3 + q[:,4]
+    r = a2*np.cos(t2) + a3*np.cos(t3) + a4*np.cos(t4)
+    dr = -np.stack([a2*np.sin(t2) + a3*np.sin(t3) + a4*np.sin(t4),
+                    a3*np.sin(t3) + a4*np.sin(t4),
+                    a4*np.sin(t4)], axis=-1)
+    dz = np.stack([r,
+                   a3*np.cos(t3) + a4*np.cos(t4),
+                   a4*np.cos(t4)], axis=-1)
+    c0 = np.cos(q[:,0])[:,np.newaxis]
+    s0 = np.sin(q[:,0])[:,np.newaxis]
+    J = np.zeros((N,4,6))
+    J[:,0,0] = -r*s0[:,0]
+    J[:,1,0] = r*c0[:,0]
+    J[:,0,[1,2,4]] = dr*c0
+    J[:,1,[1,2,4]] = dr*s0
+    J[:,2,[1,2,4]] = dz
+    J[:,3,[1,2,4]] = 1.0
+    return J
+
+""" Weight of phi against x,y,z (mm per rad) in IK_velocity """
+PHI_WEIGHT = 100.0
+
+def IK_velocity(joint_angles, dpose, damping=1.0, l4=DH_A[3]):
+    """
+    Damped least squares velocity IK step
 
+    dpose is the desired change (or rate) of (x, y, z, phi), one row per
+    joint vector. Returns the joint change (or rate)
+    dq = J^T (J J^T + damping^2 I)^-1 dpose, which stays bounded near
+    singularities. The phi row is scaled by PHI_WEIGHT so both are in mm,
+    as is damping.
+    """
+    W = np.array([1.0, 1.0, 1.0, PHI_WEIGHT])
+    J = jacobian_batch(joint_angles, l4)*W[:,np.newaxis]
+    dpose = np.atleast_2d(np.asarray(dpose, dtype=float))*W
+    JJt = np.matmul(J, J.transpose(0,2,1)) + (damping**2)*np.identity(4)
+    return np.matmul(J.transpose(0,2,1), np.linalg.solve(JJt, dpose[...,np.newaxis]))[...,0]
+
+""" Gripper length (mm) from the wrist to the grasp point, used by IK """
+L_GRIP = 128.0
+
+# IK() has always returned joint vectors with the shoulder offset by pi/2 and
+# shoulder, elbow and wrist2 mirrored with respect to the DH model above; the
+# state machine sends them to the arm as is, so IK_batch results are mapped
+# through these before being returned by IK() and IK2()
+IK_SIGN = np.array([1.0, -1.0, -1.0, 1.0, -1.0, 1.0])
+IK_OFFSET = np.array([0.0, np.pi/2, 0.0, 0.0, 0.0, 0.0])
+
+""" Branch indices of IK_batch results """
+ELBOW_UP = 0
+ELBOW_DOWN = 1
+
+def IK_batch(poses, phi=None, l4=DH_A[3]):
+    """
+    Vectorized closed-form inverse kinematics in the convention of FK_dh
+
+    poses is an (N, 3) array of x,y,z targets in mm, or (N, 4) with phi as
+    the last column. phi is the approach angle as returned by
+    get_pose_from_T (-pi points the gripper straight down, the default),
+    either a scalar or one per pose. l4 is the distance from the wrist
+    joint to the target point along the gripper.
+
+    return (angles, valid): angles is (N, 2, 6) with the elbow up and
+    elbow down solution of every pose (index with ELBOW_UP/ELBOW_DOWN),
+    valid is an (N, 2) boolean mask of the solutions that exist.
+    Joint limits are not checked here.
+    """
+    poses = np.atleast_2d(np.asarray(poses, dtype=float))
+    if phi is None:
+        phi = poses[:,3] if poses.shape[1] > 3 else -np.pi
+    phi = np.broadcast_to(np.asarray(phi, dtype=float), poses.shape[:1])
+    x = poses[:,0]
+    y = poses[:,1]
+    z = poses[:,2]
+    a2, a3 = DH_A[1], DH_A[2]
+
+    base = np.arctan2(y, x)
+    # psi is the angle of the gripper above the horizontal in the arm plane
+    psi = phi + np.pi/2
+    r = np.sqrt(x**2 + y**2) - l4*np.cos(psi)
+    h = z - l4*np.sin(psi) - DH_D[0]
+    c3 = (r**2 + h**2 - a2**2 - a3**2)/(2*a2*a3)
+    reachable = np.abs(c3) <= 1.0
+    # elbow up bends the elbow clockwise in the arm plane
+    t3 = np.arccos(np.clip(c3, -1.0, 1.0))[:,np.newaxis]*np.array([-1.0, 1.0])
+    t2 = np.arctan2(h, r)[:,np.newaxis] - np.arctan2(a3*np.sin(t3), a2 + a3*np.cos(t3))
+
+    angles = np.zeros(poses.shape[:1] + (2, 6))
+    angles[...,0] = base[:,np.newaxis]
+    angles[...,1] = t2 - np.pi/2
+    angles[...,2] = t3
+    angles[...,4] = psi[:,np.newaxis] - t2 - t3
+    angles = (angles + np.pi) % (2*np.pi) - np.pi
+    valid = np.repeat(reachable[:,np.newaxis], 2, axis=1)
+    return angles, valid
+
+def dh_to_ik_angles(joint_angles):
+    """ Map joint vectors from the FK_dh convention to the one IK() returns """
+    q = np.asarray(joint_angles)
+    return q*IK_SIGN[:q.shape[-1]] + IK_OFFSET[:q.shape[-1]]
+
+def ik_to_dh_angles(joint_angles):
+    """ Map joint vectors from the convention IK() returns to the FK_dh one """
+    q = np.asarray(joint_angles)
+    return (q - IK_OFFSET[:q.shape[-1]])*IK_SIGN[:q.shape[-1]]
 
-# def IK2(pose, alpha):
-#     l1=118
-#     l2=99
-#     l3=112
-#     l4=128
-
-#     x = pose[0]
-#     y = pose[1]
-#     z = pose[2]
-#     alpha = alpha
-#     print("IK Worksapce Location:", pose)
-#     print("Arm Angle:", alpha)
-#     d=sqrt(x**2+y**2) # gripper distance away from origin in xy plane
-#     base_theta = atan2(y,x) # Base angle
-#     far_range = l2+l3+sin(alpha)*l4
-#     if d <= far_range: # Check valid furthest range
-#         # Two cases z<l1, z>l1
-#         if z<=l1: # z is low
-#             p = l4*cos(alpha)-(l1-z)
-#             theta2 = atan2(p/d)
-#             m2 = d**2+p**2
-#         else: # stack, z is high
-#             p = l4*cos(alpha)
-#             f = d-l4*sin(alpha)
-#             theta2 = atan2((p+z-l1)/f)
-#             m2 = f**2 + (z-l1+p)**2
-#         # The rest of IK are the same for both cases    
-#         if -1 <= (l2**2 + l3**2 - m2)/(2*l2*l3) <= 1: # arccos domain check
-#             elbow_theta = np.pi-acos((l2**2 + l3**2 - m2)/(2*l2*l3))
-#             phi1 = elbow_theta - acos((m2+l3**2-l2**2)/(2*l3*sqrt(m2)))
-#             shoulder_theta = np.pi-(phi1+phi2)
-#             w2_theta = np.pi-(elbow_theta-phi1+np.pi/2-phi2+alpha)
-#             print("IK Configuration:", [base_theta*180/np.pi, shoulder_theta*180/np.pi, elbow_theta*180/np.pi, 0, w2_theta*180/np.pi, 0])
-#             return [[base_theta, shoulder_theta-np.pi/2, elbow_theta, 0, w2_theta, 0]]
-#         else: # arccos domain check false
-#             return None
-#     else: # valid furthest range false
-#         return None
+def IK(pose):
+    """
+    Calculate inverse kinematics for rexarm with the gripper pointing
+    straight down, elbow up
+
+    return the required joint angles as [[...]], None if not reachable
+    """
+    return IK2(pose, 0.0)
+
+def IK2(pose, alpha):
+    """
+    Like IK, with the gripper tilted by alpha from vertical towards the
+    outside (pi/2 approaches horizontally)
+    """
+    angles, valid = IK_batch(pose[0:3], alpha - np.pi, L_GRIP)
+    if not valid[0,ELBOW_UP]:
+        return None
+    return [dh_to_ik_angles(angles[0,ELBOW_UP]).tolist()]
 
 
 def get_euler_angles_from_T(T):
@@ -210,22 +282,34 @@ def get_euler_angles_from_T(T):
 
 def get_pose_from_T(T):
     """
-    TODO: implement this function
-    return the joint pose from a T matrix
+    return the pose from a T matrix (or an (N, 4, 4) array of them)
     of the form (x,y,z,phi) where phi is rotation about base frame y-axis
+
+    note: phi matches shoulder+elbow+wrist2, 0 with the gripper pointing up
    
     """
-    pass
+    T = np.asarray(T)
+    # the last link rotates by psi = phi + pi/2 about the rotated z-axis,
+    # which puts (sin psi, cos psi) in the bottom row of R
+    phi = np.arctan2(T[...,2,0], T[...,2,1]) - np.pi/2
+    phi = (phi + np.pi) % (2*np.pi) - np.pi
+    return np.stack([T[...,0,3], T[...,1,3], T[...,2,3], phi], axis=-1)
 
 
 
 
 def to_s_matrix(w,v):
     """
-    TODO: implement this function
     Find the [s] matrix for the POX method e^([s]*theta)
+
+    w and v may be single 3-vectors or (N, 3) arrays
     """
-    pass
+    w = np.asarray(w, dtype=float)
+    v = np.asarray(v, dtype=float)
+    S = np.zeros(w.shape[:-1] + (4,4))
+    S[...,:3,:3] = se3.skew(-w)
+    S[...,:3,3] = v
+    return S
 
 #
 # if __name__ == '__main__':
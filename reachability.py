@@ -0,0 +1,108 @@
+import os
+import numpy as np
+from kinematics import *
+
+"""
+Precomputed reachability of the board for the gripper.
+
+The grid covers x, y, z (mm, base frame, grasp point as used by IK) and a
+few approach angles phi. Every cell is solved with IK_batch once, the joint
+solutions of both elbow branches are checked against the Rexarm angle
+limits, and the result is cached next to this module so later lookups
+are a single array index. Every query is for one elbow branch, ELBOW_UP
+unless given, the only one IK() and IK2() return.
+"""
+
+""" Approach angles of the grid, -pi is straight down """
+PHIS = np.array([-np.pi, -3*np.pi/4, -np.pi/2])
+
+""" Layout of the cached arrays, part of the cache parameters """
+MAP_VERSION = 3
+
+""" Cache file, in the directory of this module whatever the working directory """
+CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "reachability_map.npz")
+
+class ReachabilityMap():
+    def __init__(self, angle_limits, x_range = (-300.0, 300.0), y_range = (-300.0, 300.0),
+                 z_range = (0.0, 200.0), step = 10.0, phis = PHIS,
+                 cache = CACHE_FILE):
+        self.angle_limits = np.asarray(angle_limits, dtype=float)
+        self.origin = np.array([x_range[0], y_range[0], z_range[0]])
+        self.step = step
+        self.shape = (int(round((x_range[1]-x_range[0])/step))+1,
+                      int(round((y_range[1]-y_range[0])/step))+1,
+                      int(round((z_range[1]-z_range[0])/step))+1)
+        self.phis = np.asarray(phis, dtype=float)
+        self.cache = cache
+        if not self.load():
+            self.build()
+            self.save()
+
+    def params(self):
+        """ Everything the map depends on, used to validate the cache """
+        return np.concatenate([self.angle_limits.ravel(), self.origin, [self.step],
+                               self.shape, self.phis, [L_GRIP], DH_A, DH_ALPHA, DH_D, DH_OFFSET,
+                               DH_JOINT, [MAP_VERSION]])
+
+    def build(self):
+        axes = [self.origin[i] + self.step*np.arange(self.shape[i]) for i in range(3)]
+        X, Y, Z, P = np.meshgrid(axes[0], axes[1], axes[2], self.phis, indexing='ij')
+        poses = np.stack([X.ravel(), Y.ravel(), Z.ravel()], axis=-1)
+        angles, valid = IK_batch(poses, P.ravel(), L_GRIP)
+        # limits apply to the angles as sent to the arm
+        cmd = dh_to_ik_angles(angles)[...,:len(self.angle_limits)]
+        valid &= np.all((cmd >= self.angle_limits[:,0]) & (cmd <= self.angle_limits[:,1]), axis=-1)
+
+        # position manipulability sqrt(det(Jp Jp^T)) of every branch
+        J = jacobian_batch(angles.reshape(-1,6), L_GRIP)[:,0:3,:]
+        w = np.sqrt(np.abs(np.linalg.det(np.matmul(J, J.transpose(0,2,1))))).reshape(valid.shape)
+        w[~valid] = 0.0
+        shape = self.shape + (len(self.phis), 2)
+        self.reachable = valid.reshape(shape)
+        self.manipulability = w.astype(np.float32).reshape(shape)
+
+    def load(self):
+        if not os.path.exists(self.cache):
+            return False
+        data = np.load(self.cache)
+        if not np.array_equal(data["params"], self.params()):
+            return False
+        self.reachable = data["reachable"]
+        self.manipulability = data["manipulability"]
+        return True
+
+    def save(self):
+        np.savez_compressed(self.cache, params = self.params(), reachable = self.reachable,
+                            manipulability = self.manipulability)
+
+    def index(self, x, y, z, phi = -np.pi):
+        """ Grid cell nearest to the pose, None if outside the grid """
+        ijk = np.round((np.array([x, y, z], dtype=float) - self.origin)/self.step).astype(int)
+        l = int(np.argmin(np.abs(self.phis - phi)))
+        if np.any(ijk < 0) or np.any(ijk >= self.shape):
+            return None
+        return (ijk[0], ijk[1], ijk[2], l)
+
+    def is_reachable(self, x, y, z, phi = -np.pi, branch = ELBOW_UP):
+        """ True if the pose has a solution within the limits on branch, None for either """
+        cell = self.index(x, y, z, phi)
+        if cell is None:
+            return False
+        if branch is None:
+            return bool(np.any(self.reachable[cell]))
+        return bool(self.reachable[cell + (branch,)])
+
+    def manipulability_at(self, x, y, z, phi = -np.pi, branch = ELBOW_UP):
+        """ Position manipulability of the pose on branch, 0 where is_reachable is False """
+        cell = self.index(x, y, z, phi)
+        return 0.0 if cell is None else float(self.manipulability[cell + (branch,)])
+
+    def best_branch(self, x, y, z, phi = -np.pi):
+        """
+        The reachable branch with the larger manipulability, None if neither
+        is. Pass it as branch to is_reachable() and manipulability_at().
+        """
+        cell = self.index(x, y, z, phi)
+        if cell is None or not np.any(self.reachable[cell]):
+            return None
+        return int(np.argmax(self.manipulability[cell]))
@@ -2,6 +2,8 @@
 import numpy as np
 from kinematics import *
 import time
+import threading
+from collections import namedtuple, OrderedDict
 
 """ 
 TODO:
@@ -15,10 +17,99 @@ add anything you see fit
 D2R = 3.141592/180.0
 R2D = 180.0/3.141592
 
+""" Trajectory timing limits per servo model, fraction of rated speed and rad/s^2 """
+VEL_FRACTION = {"MX": 0.2, "AX": 0.15, "XL": 0.15}
+ACCEL_LIMIT = {"MX": 6.0, "AX": 3.0, "XL": 3.0}
+
+""" Weight of a new sample in the smoothed command latency """
+LATENCY_GAIN = 0.1
+
+""" Immutable, timestamped feedback published by the bus I/O thread """
+Feedback = namedtuple('Feedback', ['stamp', 'positions', 'speeds', 'loads', 'temps', 'moving'])
+
+class RexarmIO(threading.Thread):
+    """
+    Owns the servo bus.  Every period it runs the pending writes, reads
+    feedback, and publishes a new Feedback snapshot.  Rebinding
+    self.snapshot is atomic, so readers in other threads need no lock and
+    never touch the bus.  Pending writes are keyed by the function they
+    call, so a newer goal for a joint (or for the whole group write)
+    replaces one not yet sent and the backlog never grows past one write
+    per function. A write or read that fails is kept and raised again
+    on the next caller thread that queues a write or asks for feedback.
+    """
+    def __init__(self, rexarm, rate = 50.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.rexarm = rexarm
+        self.period = 1.0/rate
+        self.commands = OrderedDict()
+        self.lock = threading.Lock()
+        self.running = True
+        self.error = None
+        self.snapshot = self.rexarm.read_feedback()
+
+    def put(self, fn, args):
+        """ Queue a write, replacing a pending one through the same fn """
+        with self.lock:
+            self.commands.pop(fn, None)
+            self.commands[fn] = (args, time.time())
+
+    def take(self):
+        """ All pending writes, oldest first, leaving none behind """
+        with self.lock:
+            commands = self.commands
+            self.commands = OrderedDict()
+        return commands
+
+    def fail(self, error):
+        """ Keep the first failure until a caller thread picks it up """
+        with self.lock:
+            if(self.error is None):
+                self.error = error
+
+    def raise_error(self):
+        """ Raise the pending failure, if any, on the calling thread """
+        with self.lock:
+            error, self.error = self.error, None
+        if(error is not None):
+            raise error
+
+    def run(self):
+        next_tick = time.time()
+        while(self.running):
+            for fn, (args, stamp) in self.take().items():
+                try:
+                    fn(*args)
+                    self.rexarm.record_latency(time.time() - stamp)
+                except Exception as e:
+                    self.fail(e)
+            try:
+                self.snapshot = self.rexarm.read_feedback()
+            except Exception as e:
+                self.fail(e)
+            next_tick += self.period
+            delay = next_tick - time.time()
+            if(delay > 0):
+                time.sleep(delay)
+            else:
+                next_tick = time.time()
+
+    def stop(self):
+        self.running = False
+
 class Rexarm():
-    def __init__(self, joints, gripper):
+    def __init__(self, joints, gripper, sync_write = None, bulk_read = None):
         self.joints = joints
         self.gripper = gripper
+        # optional DXL_SYNC_WRITE, sends all joint commands in one packet
+        self.sync_write = sync_write
+        # optional DXL_BULK_READ, reads all joint feedback in one transaction
+        self.bulk_read = bulk_read
+        # RexarmIO thread owning the bus once start_io() is called
+        self.io = None
+        # smoothed seconds from a dispatch() call until the write hit the bus
+        self.latency = 0.0
         self.gripper_open_pos = np.deg2rad(-90)
         self.gripper_closed_pos = np.deg2rad(75)
         self.gripper_state = True
@@ -30,7 +121,11 @@ class Rexarm():
                             [-115, 104],
                             [-150, 150],
                             [-128, 129],
-                            [-180, 180]], dtype=np.float)*D2R
+                            [-180, 180]], dtype=float)*D2R
+
+        """ Velocity (rad/s) and acceleration (rad/s^2) limits for trajectory timing """
+        self.vel_limits = np.array([VEL_FRACTION[joint.type]*joint.max_speed for joint in joints])
+        self.accel_limits = np.array([ACCEL_LIMIT[joint.type] for joint in joints])
 
         """ Commanded Values """
         self.num_joints = len(joints)
@@ -38,12 +133,10 @@ class Rexarm():
         self.speed = [1.0] * self.num_joints        # 0 to 1
         self.max_torque = [1.0] * self.num_joints   # 0 to 1
 
-        """ Feedback Values """
-        self.joint_angles_fb = [0.0] * self.num_joints # degrees
-        self.speed_fb = [0.0] * self.num_joints        # 0 to 1   
-        self.load_fb = [0.0] * self.num_joints         # -1 to 1  
-        self.temp_fb = [0.0] * self.num_joints         # Celsius
-        self.move_fb = [0] *  self.num_joints
+        """ Feedback Values: positions (rad), speeds (0 to 1), loads (-1 to 1),
+        temps (Celsius) and moving status, last read while no I/O thread runs """
+        zeros = (0.0,) * self.num_joints
+        self.feedback = Feedback(0.0, zeros, zeros, zeros, zeros, (0,) * self.num_joints)
 
     def initialize(self):
         for joint in self.joints:
@@ -56,14 +149,49 @@ class Rexarm():
             self.gripper.set_speed(0.8)
             self.close_gripper()
 
+    def start_io(self, rate = 50.0):
+        """ Hand the bus to a RexarmIO thread running at rate Hz """
+        self.io = RexarmIO(self, rate)
+        self.io.start()
+
+    def stop_io(self):
+        if(self.io is not None):
+            self.io.stop()
+            self.io.join()
+            self.io = None
+
+    def on_bus_thread(self):
+        """ True if the caller may talk to the servos directly """
+        return (self.io is None) or (threading.current_thread() is self.io)
+
+    def dispatch(self, fn, *args):
+        """ Run a bus write now, or queue it for the I/O thread when it owns the bus """
+        if(self.on_bus_thread()):
+            stamp = time.time()
+            fn(*args)
+            self.record_latency(time.time() - stamp)
+        else:
+            self.io.raise_error()
+            self.io.put(fn, args)
+
+    def record_latency(self, latency):
+        """ Smooth the time from issuing a bus write to its completion """
+        self.latency += LATENCY_GAIN*(latency - self.latency)
+
+    def get_snapshot(self):
+        """ Latest Feedback without touching the bus, for readouts on any thread """
+        if(self.io is None):
+            return self.feedback
+        return self.io.snapshot
+
     def open_gripper(self):
         """ TODO """
-        self.gripper.set_position(self.gripper_open_pos)
+        self.dispatch(self.gripper.set_position, self.gripper_open_pos)
         self.gripper_state = False
 
     def close_gripper(self):
         """ TODO """
-        self.gripper.set_position(self.gripper_closed_pos)
+        self.dispatch(self.gripper.set_position, self.gripper_closed_pos)
         self.gripper_state = True
 
     def toggle_gripper(self):
@@ -81,81 +209,113 @@ class Rexarm():
         for i,joint in enumerate(self.joints):
             self.position[i] = joint_angles[i]
             if(update_now):
-                joint.set_position(joint_angles[i])
+                self.dispatch(joint.set_position, joint_angles[i])
     
     def set_speeds_normalized_global(self, speed, update_now = True):
         for i,joint in enumerate(self.joints):
             self.speed[i] = speed
             if(update_now):
-                joint.set_speed(speed)
+                self.dispatch(joint.set_speed, speed)
 
     def set_speeds_normalized(self, speeds, update_now = True):
         for i,joint in enumerate(self.joints):
             self.speed[i] = speeds[i]
             if(update_now):
-                joint.set_speed(speeds[i])
+                self.dispatch(joint.set_speed, speeds[i])
 
     def set_speeds(self, speeds, update_now = True):
         for i,joint in enumerate(self.joints):
             self.speed[i] = speeds[i]
-            speed_msg = abs(speeds[i]/joint.max_speed)
-            if (speed_msg < 3.0/1023.0):
-                speed_msg = 3.0/1023.0
             if(update_now):
-                joint.set_speed(speed_msg)
+                self.dispatch(joint.set_speed, self.normalize_speed(joint, speeds[i]))
+
+    def normalize_speed(self, joint, speed):
+        """ rad/s to the 0 to 1 range of the joint, never 0 (0 means max speed) """
+        speed_msg = abs(speed/joint.max_speed)
+        if (speed_msg < 3.0/1023.0):
+            speed_msg = 3.0/1023.0
+        return speed_msg
+
+    def set_positions_speeds(self, joint_angles, speeds):
+        """
+        Command positions and speeds (rad/s) of all joints together.
+        With a sync writer this is a single packet per tick instead of
+        two round trips per joint.
+        """
+        self.clamp(joint_angles)
+        speeds_msg = [0.0] * self.num_joints
+        for i,joint in enumerate(self.joints):
+            self.position[i] = joint_angles[i]
+            self.speed[i] = speeds[i]
+            speeds_msg[i] = self.normalize_speed(joint, speeds[i])
+        self.dispatch(self.write_positions_speeds, list(self.position), speeds_msg)
+
+    def write_positions_speeds(self, positions, speeds_msg):
+        if(self.sync_write is not None):
+            self.sync_write.set_positions_speeds(positions, speeds_msg)
+        else:
+            for i,joint in enumerate(self.joints):
+                joint.set_position(positions[i])
+                joint.set_speed(speeds_msg[i])
     
     def set_torque_limits(self, torques, update_now = True):
         for i,joint in enumerate(self.joints):
             self.max_torque[i] = torques[i]
             if(update_now):
-                joint.set_torque_limit(torques[i])
+                self.dispatch(joint.set_torque_limit, torques[i])
 
     def send_commands(self):
-        self.set_positions(self.position)
-        self.set_speeds_normalized(self.speed)
+        if(self.sync_write is not None):
+            self.clamp(self.position)
+            self.dispatch(self.sync_write.set_positions_speeds, list(self.position), list(self.speed))
+        else:
+            self.set_positions(self.position)
+            self.set_speeds_normalized(self.speed)
         self.set_torque_limits(self.max_torque)
 
     def enable_torque(self):
         for joint in self.joints:
-            joint.enable_torque()
+            self.dispatch(joint.enable_torque)
 
     def disable_torque(self):
         for joint in self.joints:
-            joint.disable_torque()
+            self.dispatch(joint.disable_torque)
 
     def get_positions(self):
-        for i,joint in enumerate(self.joints):
-            self.joint_angles_fb[i] = joint.get_position()
-        return self.joint_angles_fb
+        return self.get_feedback().positions
 
     def get_speeds(self):
-        for i,joint in enumerate(self.joints):
-            self.speed_fb[i] = joint.get_speed()
-        return self.speed_fb
+        return self.get_feedback().speeds
 
     def get_loads(self):
-        for i,joint in enumerate(self.joints):
-            self.load_fb[i] = joint.get_load()
-        return self.load_fb
+        return self.get_feedback().loads
 
     def get_temps(self):
-        for i,joint in enumerate(self.joints):
-            self.temp_fb[i] = joint.get_temp()
-        return self.temp_fb
+        return self.get_feedback().temps
 
-       
-        
     def get_moving_status(self):
-        for i,joint in enumerate(self.joints):
-            self.move_fb[i] = joint.is_moving()
-        return self.move_fb
+        return self.get_feedback().moving
 
     def get_feedback(self):
-        self.get_positions()
-        self.get_speeds()
-        self.get_loads()
-        self.get_temps()
-        self.get_moving_status()
+        """
+        Current Feedback. Read from the servos when the caller owns the bus,
+        else the I/O thread snapshot, after raising any failure the I/O
+        thread ran into. The tuples are never modified, so a caller can
+        keep one Feedback and read consistent values from it.
+        """
+        if(self.on_bus_thread()):
+            self.feedback = self.read_feedback()
+            return self.feedback
+        self.io.raise_error()
+        return self.io.snapshot
+
+    def read_feedback(self):
+        """ Read position, speed, load, temp and moving status of all joints as a Feedback """
+        if(self.bulk_read is not None):
+            feedback = self.bulk_read.read()
+        else:
+            feedback = [joint.get_feedback() for joint in self.joints]
+        return Feedback(time.time(), *(tuple(values) for values in zip(*feedback)))
 
     def pause(self, secs):
         time_start = time.time()
@@ -174,9 +334,11 @@ class Rexarm():
                 joint_angles[i] = self.angle_limits[i][0]
         pass
 
-    def get_wrist_pose(self):
-        """TODO"""
-        end_effector_angle=FK_dh(self.joint_angles_fb,self.num_joints)   
+    def get_wrist_pose(self, feedback = None):
+        """ End effector position of feedback, the latest snapshot if None """
+        if(feedback is None):
+            feedback = self.get_snapshot()
+        end_effector_angle=FK_dh(feedback.positions,self.num_joints)   
         end_effector_angle=(end_effector_angle.flatten()).tolist()
 
         # print ("end_effector_angle is ",end_effector_angle)
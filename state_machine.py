@@ -4,6 +4,7 @@ import cv2
 import csv
 from math import * 
 import kinematics as kine
+from reachability import ReachabilityMap
 from PyQt4.QtCore import (QThread, Qt, pyqtSignal, pyqtSlot, QTimer)
 from PyQt4.QtGui import (QPixmap, QImage, QApplication, QWidget, QLabel, QMainWindow, QCursor)
 """
@@ -21,6 +22,9 @@ calibration_done=False
 pixel_center=0
 camMatrix = 0
 
+""" Lowest height in mm of the pose above a drop point that drops start and end at """
+DROP_CLEARANCE = 120
+
 
 class StateMachine():
     def __init__(self, rexarm, planner, kinect):
@@ -31,6 +35,8 @@ class StateMachine():
         self.current_state = "idle"
         self.next_state = "idle"
         self.WC = [0,0,0]
+        # Loaded from disk, built on the first run or when the limits change
+        self.reach = ReachabilityMap(self.rexarm.angle_limits)
 
 
     def set_next_state(self, state):
@@ -345,14 +351,15 @@ class StateMachine():
         return pixel_center
 
     def find_z_at_xy(self,x,y):
-            # Taking in the pixel values in camera frame and transforming to the kinect depth frame
-            pixel_value=np.array([x,y])
-            # Converting 10 bit depth to real distance using provided analytical function
-            z = self.kinect.currentDepthFrame[int(pixel_value.item(1))][int(pixel_value.item(0))]
-            Z = 12.36 * np.tan(float(z)/2842.5 + 1.1863)
-            # 95 cm marks the z location of the base plane wrt to the camera. Subtracting 95 to measure +z from the base plane
-            Z = 95-Z
-            return Z
+            # x, y may also come as single element (column) arrays
+            pixel_value=np.array([x,y],dtype=float).ravel()
+            # Height above the base plane in cm, looked up from the depth model in the
+            # newest pinned depth frame, nan before the first capture
+            frame=self.kinect.latest_frame()
+            if frame is None:
+                return np.nan
+            with frame:
+                return self.kinect.depth_model.height_at(frame.depth,pixel_value.item(0),pixel_value.item(1))/10
 
     def pixel_to_world_coords(self,x,y):
             #############################################
@@ -374,33 +381,92 @@ class StateMachine():
             world_value=np.matmul(affine,pixel_value.T)
             return (world_value)
 
-    def execute_fast_movement(self,pose_togo):
+    def pixels_to_world(self,pixels):
+            # World x,y in cm of many pixels (N,2) at once, as pixel_to_world_coords
+            pix_center=self.pixel_center_loc()
+            offset=np.stack([pixels[:,0]-pix_center.item(0),pix_center.item(1)-pixels[:,1]],axis=-1)
+            return np.matmul(offset,self.return_affine()[0:2,0:2].T)
+
+    def block_pose(self,x,y,dz=0):
+            # Pose in mm of the point dz cm above the surface at pixel x,y
+            Z=self.find_z_at_xy(x,y)
+            world_value=self.pixel_to_world_coords(x,y)
+            return [world_value.item(0)*10,world_value.item(1)*10,(Z+dz)*10]
+
+    def is_reachable(self,poses):
+            # Cheap check against the reachability map before committing to a move
+            return all(self.reach.is_reachable(*pose) for pose in poses)
+
+    def plan_movement(self,segments):
+        # Plans for segments from the last commanded waypoint. A segment is
+        # (pose_togo, vel_scale), vel_scale being the fraction of the Rexarm joint
+        # velocity limits, or (pose_togo, vel_scale, line_pose) for a straight line
+        # of the gripper to line_pose (mm) with pose_togo at vel_scale as the joint
+        # space fallback when the line is not feasible. Consecutive joint space
+        # segments are joined into one trajectory
+        plans=[]
+        waypoints=[self.tp.set_initial_wp()]
+        scales=[]
+        for segment in segments:
+            pose_togo, vel_scale = segment[0], segment[1]
+            if len(segment) > 2:
+                line = self.tp.plan_cached("line", waypoints[-1], segment[2])
+                if line is not None:
+                    plans += self.plan_waypoints(waypoints, scales)
+                    plans.append(line)
+                    waypoints=[line[0][-1].tolist()]
+                    scales=[]
+                    continue
             for i, wp in enumerate(pose_togo):
-                if i==0 and wp==np.zeros(self.rexarm.num_joints).tolist():
-                    pass
-                else:
-                    # print(wp)
-                    # print(type(wp))
-                    initial_wp = self.tp.set_initial_wp()
-                    final_wp = self.tp.set_final_wp(wp)
-                    T = self.tp.calc_time_from_waypoints(initial_wp, final_wp, 1)
-                    plan_pts, plan_velos = self.tp.generate_quintic_spline(initial_wp, final_wp,T)
-                    self.tp.execute_plan(plan_pts, plan_velos)
-                    self.rexarm.pause(1)
+                if i==0 and list(wp)==np.zeros(self.rexarm.num_joints).tolist():
+                    continue
+                waypoints.append(wp)
+                scales.append(vel_scale)
+        return plans + self.plan_waypoints(waypoints, scales)
+
+    def plan_waypoints(self,waypoints,scales):
+        # One trajectory through the waypoints, move i at velocity fraction scales[i].
+        # No plan if there is no move
+        if not scales:
+            return []
+        if len(scales) == 1:
+            # a single move is fastest as a synchronized trapezoid
+            T = self.tp.calc_time_optimal(waypoints[0], waypoints[1], scales[0])
+            return [self.tp.plan_cached("trapezoidal", waypoints[0], waypoints[1], T)]
+        durations=[self.tp.calc_time_optimal(waypoints[i], waypoints[i+1], scales[i], "cubic") for i in range(len(scales))]
+        return [self.tp.plan_cached("multi_waypoint", waypoints, durations)]
+
+    def execute_movement(self,segments):
+        # Run the plans of segments (see plan_movement) one after the other. Each
+        # plan returns once the arm has settled on its end, so a straight line
+        # starts from where the plan before it ended. Every plan is validated
+        # before the arm moves; False, with the arm where it was, if one is
+        # rejected
+        plans=self.plan_movement(segments)
+        for plan_pts, plan_velos in plans:
+            violation = self.tp.validate_plan(plan_pts, plan_velos)
+            if violation is not None:
+                print("Movement rejected at sample {} of {}: {}".format(violation[0], len(plan_pts), violation[1]))
+                return False
+        for plan_pts, plan_velos in plans:
+            self.tp.execute_stream(zip(plan_pts, plan_velos))
+            if self.rexarm.estop:
+                return False
+            self.tp.set_final_wp(list(plan_pts[-1]))
+        return True
+
+    def abort_sequence(self):
+        # A plan was rejected before it moved the arm, which stays at the end of the
+        # last accepted one. Drop the rest of the sequence and go back to idle
+        print("Sequence aborted, the arm did not reach the next pose")
+        self.next_state = "idle"
+        return False
+
+    def execute_fast_movement(self,pose_togo):
+        return self.execute_movement([(pose_togo, 1)])
 
     def execute_slow_movement(self,pose_togo):
-        for i, wp in enumerate(pose_togo):
-            if i==0 and wp==np.zeros(self.rexarm.num_joints).tolist():
-                pass
-            else:
-                # print(wp)
-                # print(type(wp))
-                initial_wp = self.tp.set_initial_wp()
-                final_wp = self.tp.set_final_wp(wp)
-                T = self.tp.calc_time_from_waypoints(initial_wp, final_wp, 0.2)
-                plan_pts, plan_velos = self.tp.generate_quintic_spline(initial_wp, final_wp,T)
-                self.tp.execute_plan(plan_pts, plan_velos)
-                self.rexarm.pause(1)
+        return self.execute_movement([(pose_togo, 0.2)])
 
         
     # Creating function for executing picking a block and placing it at other locations
@@ -419,13 +485,8 @@ class StateMachine():
             #       CAMERA FRAME TO DEPTH FRAME         #
             #############################################
 
-            # Taking in the pixel values in camera frame and transforming to the kinect depth frame
-            pixel_value=np.array([x,y])
-            # Converting 10 bit depth to real distance using provided analytical function
-            z = self.kinect.currentDepthFrame[int(pixel_value.item(1))][int(pixel_value.item(0))]
-            Z = 12.36 * np.tan(float(z)/2842.5 + 1.1863)
-            # 95 cm marks the z location of the base plane wrt to the camera. Subtracting 95 to measure +z from the base plane
-            Z = 95-Z
+            # Height above the base plane in cm
+            Z = self.find_z_at_xy(x,y)
 
             #############################################
             #       CAMERA FRAME TO WORLD FRAME         #
@@ -466,10 +527,12 @@ class StateMachine():
                         print(wp)
                         # print(type(wp))
                         initial_wp = self.tp.set_initial_wp()
-                        final_wp = self.tp.set_final_wp(wp)
+                        final_wp = wp
                         T = self.tp.calc_time_from_waypoints(initial_wp, final_wp, 1)
                         plan_pts, plan_velos = self.tp.generate_quintic_spline(initial_wp, final_wp,T)
-                        self.tp.execute_plan(plan_pts, plan_velos)
+                        if not self.tp.execute_plan(plan_pts, plan_velos):
+                            return self.abort_sequence()
+                        self.tp.set_final_wp(final_wp)
                         self.rexarm.pause(1)
                 
                 # Calling the Inverse Kinematics function to determine the required joint angles for Pose 2 
@@ -483,10 +546,12 @@ class StateMachine():
                             print(wp)
                             print(type(wp))
                             initial_wp = self.tp.set_initial_wp()
-                            final_wp = self.tp.set_final_wp(wp)
+                            final_wp = wp
                             T = self.tp.calc_time_from_waypoints(initial_wp, final_wp, 0.2)
                             plan_pts, plan_velos = self.tp.generate_quintic_spline(initial_wp, final_wp,T)
-                            self.tp.execute_plan(plan_pts, plan_velos)
+                            if not self.tp.execute_plan(plan_pts, plan_velos):
+                                return self.abort_sequence()
+                            self.tp.set_final_wp(final_wp)
                             self.rexarm.pause(1)
                     self.rexarm.toggle_gripper() #close
 
@@ -500,10 +565,12 @@ class StateMachine():
                             print(wp)
                             print(type(wp))
                             initial_wp = self.tp.set_initial_wp()
-                            final_wp = self.tp.set_final_wp(wp)
+                            final_wp = wp
                             T = self.tp.calc_time_from_waypoints(initial_wp, final_wp, 1)
                             plan_pts, plan_velos = self.tp.generate_quintic_spline(initial_wp, final_wp,T)
-                            self.tp.execute_plan(plan_pts, plan_velos)
+                            if not self.tp.execute_plan(plan_pts, plan_velos):
+                                return self.abort_sequence()
+                            self.tp.set_final_wp(final_wp)
                             self.rexarm.pause(1)
                     self.rexarm.toggle_gripper()
                     self.rexarm.toggle_gripper()
@@ -538,6 +605,15 @@ class StateMachine():
             pose2=[world_value.item(0)*10,world_value.item(1)*10,Z*10]
             # print ("X, Y, Z values of the location to pick block is ",pose2)
             
+            # Reject the block before touching the gripper if any pick or drop pose is out of reach
+            x_drop=drop_coordinates[0][0]
+            y_drop=drop_coordinates[1][0]
+            pose_pre_drop=self.block_pose(x_drop,y_drop,7)
+            pose_pre_drop[2]=max(DROP_CLEARANCE,pose_pre_drop[2])
+            if not self.is_reachable([pose1, pose2, pose_pre_drop, self.block_pose(x_drop,y_drop,1)]):
+                print ("Block or drop location is outside the reachable workspace")
+                return
+
             # Calling the Inverse Kinematics function to determine the required joint angles for Pose 1
             execute_states = kine.IK(pose1)
 
@@ -547,9 +623,6 @@ class StateMachine():
             else:
                 print ("Goint to step 1 to pick item at pose",execute_states)
                 print("Z to pick up item 3 cm above is",Z+3)
-                self.rexarm.toggle_gripper() # open
-                self.execute_fast_movement(execute_states)
-                
                 # Calling the Inverse Kinematics function to determine the required joint angles for Pose 2 
                 
                 down_states = kine.IK(pose2)
@@ -558,13 +631,17 @@ class StateMachine():
                 else:
                     print ("Goint to step 2 to pick item at pose",down_states)
                     print("Z to pick up item above is",Z)
-                    self.execute_slow_movement(down_states)
+                    self.rexarm.toggle_gripper() # open
+                    # Approach fast, then a straight vertical descent (slow joint space
+                    # move if the line is not feasible), settling only at the block
+                    if not self.execute_movement([(execute_states, 1), (down_states, 0.2, pose2)]):
+                        return self.abort_sequence()
                     self.rexarm.toggle_gripper() #close
 
                     ## Once the block has been picked the arm should open up to ensure block is properly gripped. This pose is defined by idlePos
-                    self.execute_slow_movement(execute_states)
                     idlePos = [[0.0, 0, 0.0, 0.0, -np.pi/4,0]]
-                    self.execute_fast_movement(idlePos)
+                    if not self.execute_movement([(execute_states, 0.2, pose1), (idlePos, 1)]):
+                        return self.abort_sequence()
                     self.rexarm.toggle_gripper() # Opening the gripper
                     self.rexarm.toggle_gripper() # Closing the gripper
 
@@ -584,7 +661,9 @@ class StateMachine():
                     x_drop=x_drop-pix_center.item(0)
                     y_drop=pix_center.item(1)-y_drop
 
-                    pose_drop_intermediate=[world_value.item(0)*10,world_value.item(1)*10,(z_drop+4)*10]
+                    # Drops start and end at a fixed height above the drop point, clear of the
+                    # stack, so the moves between it and idle are the same for every block
+                    pose_drop_intermediate=[world_value.item(0)*10,world_value.item(1)*10,max(DROP_CLEARANCE,(z_drop+7)*10)]
                     down_states_intermediate = kine.IK(pose_drop_intermediate)
 
                     if down_states_intermediate is None:
@@ -592,7 +671,6 @@ class StateMachine():
                     else:
                         print ("Goint to step 3 to drop item at pose",down_states_intermediate)
                         # print ("Z to drop up item 3 cm above is",z_drop+7)
-                        self.execute_fast_movement(down_states_intermediate)
 
                         pose_drop=[world_value.item(0)*10,world_value.item(1)*10,(z_drop+1)*10]
                         down_states = kine.IK(pose_drop)
@@ -603,24 +681,14 @@ class StateMachine():
                         else:
                             print ("Goint to step 4 to drop item at pose",down_states)
                             # print ("Z to drop up item 1 cm above is",z_drop+3)
-                            self.execute_slow_movement(down_states)
+                            if not self.execute_movement([(down_states_intermediate, 1), (down_states, 0.2, pose_drop)]):
+                                return self.abort_sequence()
                             self.rexarm.toggle_gripper() # Opening the gripper
 
-                            pose_interm_up=[world_value.item(0)*10,world_value.item(1)*10,(z_drop+7)*10]
-                            intermediate_up_states = kine.IK(pose_interm_up)
-                            print("Before Update intermediate_up_states",intermediate_up_states)
-
-                            if intermediate_up_states is None:
-                                print("Cannot go to pose to drop the block (block picked up")
-                            else:
-                                print ("Goint to step 5 intermediate_up_states",intermediate_up_states)
-                                self.execute_slow_movement(intermediate_up_states)
-                                # self.rexarm.toggle_gripper() # Opening the gripper
-
-
-                                idlePos = [[0.0, 0, 0.0, 0.0, -np.pi/4,0]]
-                                self.execute_fast_movement(idlePos)
-                                self.rexarm.toggle_gripper() # Opening the gripper
+                            idlePos = [[0.0, 0, 0.0, 0.0, -np.pi/4,0]]
+                            if not self.execute_movement([(down_states_intermediate, 0.2, pose_drop_intermediate), (idlePos, 1)]):
+                                return self.abort_sequence()
+                            self.rexarm.toggle_gripper() # Opening the gripper
                             # self.rexarm.toggle_gripper() # Closing the gripper
 
 
@@ -657,9 +725,6 @@ class StateMachine():
             else:
                 print ("Goint to step 1 to pick item at pose",execute_states)
                 print("Z to pick up item 3 cm above is",Z+3)
-                self.rexarm.toggle_gripper() # open
-                self.execute_fast_movement(execute_states)
-                
                 # Calling the Inverse Kinematics function to determine the required joint angles for Pose 2 
                 
                 down_states = kine.IK(pose2)
@@ -668,13 +733,17 @@ class StateMachine():
                 else:
                     print ("Goint to step 2 to pick item at pose",down_states)
                     print("Z to pick up item above is",Z)
-                    self.execute_slow_movement(down_states)
+                    self.rexarm.toggle_gripper() # open
+                    # Approach fast, then a straight vertical descent (slow joint space
+                    # move if the line is not feasible), settling only at the block
+                    if not self.execute_movement([(execute_states, 1), (down_states, 0.2, pose2)]):
+                        return self.abort_sequence()
                     self.rexarm.toggle_gripper() #close
 
                     ## Once the block has been picked the arm should open up to ensure block is properly gripped. This pose is defined by idlePos
-                    self.execute_slow_movement(execute_states)
                     idlePos = [[0.0, 0, 0.0, 0.0, -np.pi/4,0]]
-                    self.execute_fast_movement(idlePos)
+                    if not self.execute_movement([(execute_states, 0.2, pose1), (idlePos, 1)]):
+                        return self.abort_sequence()
                     self.rexarm.toggle_gripper() # Opening the gripper
                     self.rexarm.toggle_gripper() # Closing the gripper
 
@@ -694,7 +763,9 @@ class StateMachine():
                     x_drop=x_drop-pix_center.item(0)
                     y_drop=pix_center.item(1)-y_drop
 
-                    pose_drop_intermediate=[world_value.item(0)*10,world_value.item(1)*10,(z_drop+4)*10]
+                    # Drops start and end at a fixed height above the drop point, clear of the
+                    # stack, so the moves between it and idle are the same for every block
+                    pose_drop_intermediate=[world_value.item(0)*10,world_value.item(1)*10,max(DROP_CLEARANCE,(z_drop+7)*10)]
                     down_states_intermediate = kine.IK(pose_drop_intermediate)
                     down_states_intermediate[0][5]=np.arctan2(y_drop,x_drop)
 
@@ -703,7 +774,6 @@ class StateMachine():
                     else:
                         print ("Goint to step 3 to drop item at pose",down_states_intermediate)
                         # print ("Z to drop up item 3 cm above is",z_drop+7)
-                        self.execute_fast_movement(down_states_intermediate)
 
                         pose_drop=[world_value.item(0)*10,world_value.item(1)*10,(z_drop+1)*10]
                         down_states = kine.IK(pose_drop)
@@ -714,25 +784,14 @@ class StateMachine():
                         else:
                             print ("Goint to step 4 to drop item at pose",down_states)
                             # print ("Z to drop up item 1 cm above is",z_drop+3)
-                            self.execute_slow_movement(down_states)
+                            if not self.execute_movement([(down_states_intermediate, 1), (down_states, 0.2, pose_drop)]):
+                                return self.abort_sequence()
                             self.rexarm.toggle_gripper() # Opening the gripper
 
-                            pose_interm_up=[world_value.item(0)*10,world_value.item(1)*10,(z_drop+7)*10]
-                            intermediate_up_states = kine.IK(pose_interm_up)
-                            print("Before Update intermediate_up_states",intermediate_up_states)
-                            intermediate_up_states[0][5]=np.arctan2(y_drop,x_drop)
-
-                            if intermediate_up_states is None:
-                                print("Cannot go to pose to drop the block (block picked up")
-                            else:
-                                print ("Goint to step 5 intermediate_up_states",intermediate_up_states)
-                                self.execute_slow_movement(intermediate_up_states)
-                                # self.rexarm.toggle_gripper() # Opening the gripper
-
-
-                                idlePos = [[0.0, 0, 0.0, 0.0, -np.pi/4,0]]
-                                self.execute_fast_movement(idlePos)
-                                self.rexarm.toggle_gripper() # Opening the gripper
+                            idlePos = [[0.0, 0, 0.0, 0.0, -np.pi/4,0]]
+                            if not self.execute_movement([(down_states_intermediate, 0.2, pose_drop_intermediate), (idlePos, 1)]):
+                                return self.abort_sequence()
+                            self.rexarm.toggle_gripper() # Opening the gripper
                             # self.rexarm.toggle_gripper() # Closing the gripper
 
    
@@ -769,9 +828,6 @@ class StateMachine():
             else:
                 print ("Goint to step 1 to pick item at pose",execute_states)
                 print("Z to pick up item 3 cm above is",Z+3)
-                self.rexarm.toggle_gripper() # open
-                self.execute_fast_movement(execute_states)
-                
                 # Calling the Inverse Kinematics function to determine the required joint angles for Pose 2 
                 
                 down_states = kine.IK(pose2)
@@ -780,13 +836,17 @@ class StateMachine():
                 else:
                     print ("Goint to step 2 to pick item at pose",down_states)
                     print("Z to pick up item above is",Z)
-                    self.execute_slow_movement(down_states)
+                    self.rexarm.toggle_gripper() # open
+                    # Approach fast, then a straight vertical descent (slow joint space
+                    # move if the line is not feasible), settling only at the block
+                    if not self.execute_movement([(execute_states, 1), (down_states, 0.2, pose2)]):
+                        return self.abort_sequence()
                     self.rexarm.toggle_gripper() #close
 
                     ## Once the block has been picked the arm should open up to ensure block is properly gripped. This pose is defined by idlePos
-                    self.execute_slow_movement(execute_states)
                     idlePos = [[0.0, 0, 0.0, 0.0, -np.pi/4,0]]
-                    self.execute_fast_movement(idlePos)
+                    if not self.execute_movement([(execute_states, 0.2, pose1), (idlePos, 1)]):
+                        return self.abort_sequence()
                     self.rexarm.toggle_gripper() # Opening the gripper
                     self.rexarm.toggle_gripper() # Closing the gripper
 
@@ -810,7 +870,9 @@ class StateMachine():
                     x_drop=x_drop-pix_center.item(0)
                     y_drop=pix_center.item(1)-y_drop
 
-                    pose_drop_intermediate=[world_value.item(0)*10,world_value.item(1)*10,(z_drop+4)*10]
+                    # Drops start and end at a fixed height above the drop point, clear of the
+                    # stack, so the moves between it and idle are the same for every block
+                    pose_drop_intermediate=[world_value.item(0)*10,world_value.item(1)*10,max(DROP_CLEARANCE,(z_drop+7)*10)]
                     down_states_intermediate = kine.IK2(pose_drop_intermediate, alpha)
 
                     if down_states_intermediate is None:
@@ -818,7 +880,6 @@ class StateMachine():
                     else:
                         print ("Goint to step 3 to drop item at pose",down_states_intermediate)
                         # print ("Z to drop up item 3 cm above is",z_drop+7)
-                        self.execute_fast_movement(down_states_intermediate)
 
                         pose_drop=[world_value.item(0)*10,world_value.item(1)*10,(z_drop+1)*10]
                         down_states = kine.IK2(pose_drop, alpha)
@@ -829,24 +890,14 @@ class StateMachine():
                         else:
                             print ("Goint to step 4 to drop item at pose",down_states)
                             # print ("Z to drop up item 1 cm above is",z_drop+3)
-                            self.execute_slow_movement(down_states)
+                            if not self.execute_movement([(down_states_intermediate, 1), (down_states, 0.2, pose_drop)]):
+                                return self.abort_sequence()
                             self.rexarm.toggle_gripper() # Opening the gripper
 
-                            pose_interm_up=[world_value.item(0)*10,world_value.item(1)*10,(z_drop+7)*10]
-                            intermediate_up_states = kine.IK2(pose_interm_up, alpha)
-                            print("Before Update intermediate_up_states",intermediate_up_states)
-
-                            if intermediate_up_states is None:
-                                print("Cannot go to pose to drop the block (block picked up")
-                            else:
-                                print ("Goint to step 5 intermediate_up_states",intermediate_up_states)
-                                self.execute_slow_movement(intermediate_up_states)
-                                # self.rexarm.toggle_gripper() # Opening the gripper
-
-
-                                idlePos = [[0.0, 0, 0.0, 0.0, -np.pi/4,0]]
-                                self.execute_fast_movement(idlePos)
-                                self.rexarm.toggle_gripper() # Opening the gripper
+                            idlePos = [[0.0, 0, 0.0, 0.0, -np.pi/4,0]]
+                            if not self.execute_movement([(down_states_intermediate, 0.2, pose_drop_intermediate), (idlePos, 1)]):
+                                return self.abort_sequence()
+                            self.rexarm.toggle_gripper() # Opening the gripper
                             # self.rexarm.toggle_gripper() # Closing the gripper
 
 
@@ -874,10 +925,12 @@ class StateMachine():
                 pass
             else:
                 initial_wp = self.tp.set_initial_wp()
-                final_wp = self.tp.set_final_wp(wp)
+                final_wp = wp
                 T = self.tp.calc_time_from_waypoints(initial_wp, final_wp, 1)
                 plan_pts, plan_velos = self.tp.generate_quintic_spline(initial_wp, final_wp,T)
-                self.tp.execute_plan(plan_pts, plan_velos)
+                if not self.tp.execute_plan(plan_pts, plan_velos):
+                    return self.abort_sequence()
+                self.tp.set_final_wp(final_wp)
                 self.rexarm.pause(1)
                 self.rexarm.toggle_gripper()
                 self.rexarm.toggle_gripper()
@@ -907,11 +960,13 @@ class StateMachine():
                 pass
             else:
                 initial_wp = self.tp.set_initial_wp()
-                final_wp = self.tp.set_final_wp(wp)
+                final_wp = wp
                 print(initial_wp)
                 T = self.tp.calc_time_from_waypoints(initial_wp, final_wp, 1)
                 plan_pts, plan_velos = self.tp.generate_cubic_spline(initial_wp, final_wp,T)
-                self.tp.execute_plan(plan_pts, plan_velos)
+                if not self.tp.execute_plan(plan_pts, plan_velos):
+                    return self.abort_sequence()
+                self.tp.set_final_wp(final_wp)
                 self.rexarm.pause(1)
                 self.rexarm.toggle_gripper()
                 self.rexarm.toggle_gripper()
@@ -926,33 +981,24 @@ class StateMachine():
     def block_detect(self):
         self.status_message = "Detecting Blocks"
         self.current_state = "block_detect"
-        self.kinect.detectBlocksInDepthImage()
-        self.kinect.blockDetector()
-        #############################################
-        #       CAMERA FRAME TO WORLD FRAME         #
-        #############################################
-        # Extracting the origin of the camera frame (Following 4 quadrant system)
-        pix_center=self.pixel_center_loc()
-        # X and Y locations in the RGB space in pixels with (0,0) at the robot base center
-        count = 0
-        for i in range(self.kinect.block_coordinates.size - 2):
-            x = int(self.kinect.block_coordinates[i+count]) 
-            y = int(self.kinect.block_coordinates[i+count+1])
-            x=x-pix_center.item(0)
-            y=pix_center.item(1)-y
-            # Taking in the pixel values in camera frame and transforming to the world frame
-            pixel_value=np.array([x,y])
-            count = count+1
-            pixel_value=np.transpose(pixel_value)
-            # Extracting the affine matrix computed during camera calibration
-            affine=self.return_affine()
-            affine=affine[0:2,0:2]
-            # print('affine:',affine,'\nxy:',pixel_value)
-            # World x,y location corresponding to iamge frame x,y location
-            world_value=np.matmul(affine,pixel_value.T)
-            print("World block coords are", world_value)
-            if(self.kinect.block_coordinates.size==count*2):
-               break
+        # Both detectors see the same pinned RGB + depth pair
+        frame = self.kinect.latest_frame()
+        if frame is None:
+            print("No Kinect frame captured yet")
+            self.next_state = "idle"
+            return
+        with frame:
+            blocks = self.kinect.detectBlocksInDepthImage(frame)
+            self.kinect.blockDetector(frame)
+            #############################################
+            #       CAMERA FRAME TO WORLD FRAME         #
+            #############################################
+            # World pose (mm) of every block top, the height from the same depth frame
+            if self.calibration_state() and len(blocks) > 0:
+                blocks['world'][:,0:2] = self.pixels_to_world(blocks['pixel'])*10
+                blocks['world'][:,2] = self.kinect.depth_model.height_at(frame.depth,blocks['pixel'][:,0],blocks['pixel'][:,1])
+        for block in blocks:
+            print("Block at", block['world'], "level", block['level'], "color", block['color'])
 
         self.next_state = "idle"
 
@@ -972,21 +1018,18 @@ class StateMachine():
         self.block_detect()
         # Denoting the location for dropping the block
         drop_coordinates=np.array([[320],[330]])
-        count=0
-        print(self.kinect.block_coordinates)
-        block_dist=[]
-        for i in range(int(len(self.kinect.block_coordinates)/2)):
-            block_dist.append(self.kinect.block_coordinates[2*i]**2+self.kinect.block_coordinates[2*i+1]**2)
-        pickorder = [i[0] for i in sorted(enumerate(block_dist), reverse=False, key=lambda x:x[1])]
-        ordered_block_coordinates = []
-        for i in pickorder:
-            ordered_block_coordinates.append(self.kinect.block_coordinates[2*i])
-            ordered_block_coordinates.append(self.kinect.block_coordinates[2*i+1])
-        print(ordered_block_coordinates)
-        for i in range(len(self.kinect.block_coordinates)-2):
-            block_coordinates=np.array([[ordered_block_coordinates[i+count]],[ordered_block_coordinates[i+count+1]]])
-            self.click_and_grab_task1(block_coordinates, drop_coordinates)
-            count=count+1
+        # Blocks closest to the image origin first
+        blocks=self.kinect.blocks
+        blocks=blocks[np.argsort(np.sum(blocks['pixel']**2,axis=1),kind='stable')]
+        # Skip blocks the arm cannot get above, so no time is spent moving toward them
+        above=blocks['world']+[0,0,30]
+        reachable=np.array([self.is_reachable([pose]) for pose in above],dtype=bool)
+        for block in blocks[~reachable]:
+            print("Skipping unreachable block at",block['pixel'])
+        for block in blocks[reachable]:
+            # a rejected movement ends the task, abort_sequence() already went back to idle
+            if self.click_and_grab_task1(block['pixel'].reshape(2,1), drop_coordinates) is False:
+                return
 
         self.next_state = "idle"
 
@@ -999,43 +1042,36 @@ class StateMachine():
         drop_coordinates=np.array([[320],[170]])
         distance=30
         # Denoting the location for dropping the block (in world coordinates (cm))
-        count=0
 
-        # Loop to unstack the blocks
-        for i in range(len(self.kinect.block_coordinates)-2):
-            block_coordinates=np.array([[self.kinect.block_coordinates[i+count]],[self.kinect.block_coordinates[i+count+1]]])
-            # Find z at the block location
-            z=find_z_at_xy(self.kinect.block_coordinates[i+count],self.kinect.block_coordinates[i+count+1])
-            
-            if z>5:
-                block_coordinates=np.array([[self.kinect.block_coordinates[i+count]],[self.kinect.block_coordinates[i+count+1]]])
-                z=find_z_at_xy(drop_coordinates[0],drop_coordinates[1])
-                while z>1:
-                    y=170
-                    x=320+distance
-                    drop_coordinates=np.array([[x],[y]])
-                    distance=distance+30
-                    print("Distance value is",distance)
-                    z=find_z_at_xy(drop_coordinates[0],drop_coordinates[1])
-                self.click_and_grab_task1(block_coordinates, drop_coordinates)
-                count=count+1
+        # Loop to unstack the blocks, every block top more than 5 cm up is on a stack
+        for block in self.kinect.blocks[self.kinect.blocks['world'][:,2]>50]:
+            z=self.find_z_at_xy(drop_coordinates[0][0],drop_coordinates[1][0])
+            while z>1:
+                y=170
+                x=320+distance
+                drop_coordinates=np.array([[x],[y]])
+                distance=distance+30
+                print("Distance value is",distance)
+                z=self.find_z_at_xy(drop_coordinates[0][0],drop_coordinates[1][0])
+            # a rejected movement ends the task, abort_sequence() already went back to idle
+            if self.click_and_grab_task1(block['pixel'].reshape(2,1), drop_coordinates) is False:
+                return
 
         # Loop to place the blocks in a line
 
         self.block_detect()
         drop_coordinates=np.array([[360],[300]])
-        count=0
         distance=30
 
-        for i in range(len(self.kinect.block_coordinates)-2):
-            block_coordinates=np.array([[self.kinect.block_coordinates[i+count]],[self.kinect.block_coordinates[i+count+1]]])
-            self.click_and_grab_task2(block_coordinates, drop_coordinates)
+        for block in self.kinect.blocks:
+            # a rejected movement ends the task, abort_sequence() already went back to idle
+            if self.click_and_grab_task2(block['pixel'].reshape(2,1), drop_coordinates) is False:
+                return
             y=300
             x=360+distance
             drop_coordinates=np.array([[x],[y]])
             distance=distance+30
             print("Distance value is",distance)
-            count=count+1
 
         self.next_state = "idle"
 
@@ -1047,37 +1083,30 @@ class StateMachine():
         drop_coordinates=np.array([[320],[170]])
         distance=30
         # Denoting the location for dropping the block (in world coordinates (cm))
-        count=0
 
-        # Loop to unstack the blocks
-        for i in range(len(self.kinect.block_coordinates)-2):
-            block_coordinates=np.array([[self.kinect.block_coordinates[i+count]],[self.kinect.block_coordinates[i+count+1]]])
-            # Find z at the block location
-            z=find_z_at_xy(self.kinect.block_coordinates[i+count],self.kinect.block_coordinates[i+count+1])
-            
-            if z>5:
-                block_coordinates=np.array([[self.kinect.block_coordinates[i+count]],[self.kinect.block_coordinates[i+count+1]]])
-                z=find_z_at_xy(drop_coordinates[0],drop_coordinates[1])
-                while z>1:
-                    y=170
-                    x=320+distance
-                    drop_coordinates=np.array([[x],[y]])
-                    distance=distance+30
-                    print("Distance value is",distance)
-                    z=find_z_at_xy(drop_coordinates[0],drop_coordinates[1])
-                self.click_and_grab_task1(block_coordinates, drop_coordinates)
-                count=count+1
+        # Loop to unstack the blocks, every block top more than 5 cm up is on a stack
+        for block in self.kinect.blocks[self.kinect.blocks['world'][:,2]>50]:
+            z=self.find_z_at_xy(drop_coordinates[0][0],drop_coordinates[1][0])
+            while z>1:
+                y=170
+                x=320+distance
+                drop_coordinates=np.array([[x],[y]])
+                distance=distance+30
+                print("Distance value is",distance)
+                z=self.find_z_at_xy(drop_coordinates[0][0],drop_coordinates[1][0])
+            # a rejected movement ends the task, abort_sequence() already went back to idle
+            if self.click_and_grab_task1(block['pixel'].reshape(2,1), drop_coordinates) is False:
+                return
 
         # Loop to place the blocks high
 
         self.block_detect()
         drop_coordinates=np.array([[360],[300]])
-        count=0
 
-        for i in range(len(self.kinect.block_coordinates)-2):
-            block_coordinates=np.array([[self.kinect.block_coordinates[i+count]],[self.kinect.block_coordinates[i+count+1]]])
-            self.click_and_grab_task3(block_coordinates, drop_coordinates)
-            count=count+1
+        for block in self.kinect.blocks:
+            # a rejected movement ends the task, abort_sequence() already went back to idle
+            if self.click_and_grab_task3(block['pixel'].reshape(2,1), drop_coordinates) is False:
+                return
 
         self.next_state = "idle"
         return None
@@ -1104,7 +1133,10 @@ class StateMachine():
                 final_wp = self.tp.set_final_wp(wp)
                 T = self.tp.calc_time_from_waypoints(initial_wp, final_wp, 1.5)
                 plan_pts, plan_velos = self.tp.generate_quintic_spline(initial_wp, final_wp,T)
-                self.tp.execute_plan_collect(plan_pts, plan_velos)
+                if not self.tp.execute_plan_collect(plan_pts, plan_velos):
+                    # the arm is still at the start of the rejected plan
+                    self.tp.set_final_wp(initial_wp)
+                    return self.abort_sequence()
                 #self.tp.execute_plan(plan_pts, plan_velos)
                 self.rexarm.pause(3)
 
@@ -1,7 +1,7 @@
 import numpy as np 
 import time
+from collections import OrderedDict
 from math import *
-from kinect import Kinect
 from kinematics import *
 
 """
@@ -10,6 +10,29 @@ TODO: build a trajectory generator and waypoint planner
         the plan at the desired command update rate
 """
 
+""" Tracking lag of the servos the commanded position leads by, seconds """
+SERVO_LAG = 0.55
+MAX_LOOK_AHEAD = 20
+
+""" Joint error (rad) a finished plan must be within before the next one
+starts, and the longest time to wait for it in seconds """
+SETTLE_TOL = 0.01
+SETTLE_TIMEOUT = 1.0
+
+""" Plans kept by plan_cached(), and the resolution its keys are rounded to """
+PLAN_CACHE_SIZE = 64
+PLAN_CACHE_QUANTUM = 1e-3
+
+""" Validation envelope in mm: lowest elbow/wrist and grasp point above the
+board, and the column around the base the wrist must stay out of below its top """
+MIN_LINK_HEIGHT = 20.0
+MIN_GRIP_HEIGHT = -10.0
+BASE_RADIUS = 50.0
+
+""" Samples used to check a Cartesian path, and the largest joint step (rad) between them """
+PATH_CHECK_SAMPLES = 100
+PATH_CONTINUITY_TOL = 0.1
+
 class TrajectoryPlanner():
     def __init__(self, rexarm, kinect):
         self.idle = True
@@ -19,6 +42,9 @@ class TrajectoryPlanner():
         self.final_wp = [0.0]*self.num_joints 
         self.dt = 0.05 # command rate
         self.kinect = kinect
+        # least recently used plan first
+        self.plan_cache = OrderedDict()
+        self.plan_cache_hits = 0
     
     def set_initial_wp(self):
         self.initial_wp = self.final_wp
@@ -42,84 +68,364 @@ class TrajectoryPlanner():
         T = max_wp_diff/max_speed
         return T
 
+    def calc_time_optimal(self, initial_wp, final_wp, vel_scale = 1.0, profile = "trapezoid"):
+        """
+        Shortest duration of a rest to rest move under the Rexarm per-joint
+        velocity and acceleration limits (velocity scaled by vel_scale);
+        every joint is then stretched to the slowest one. For the
+        polynomial profiles the bound follows from their peak velocity
+        (1.5 and 1.875 d/T) and peak acceleration (6 and 5.77 d/T^2).
+        """
+        d = np.abs(np.asarray(final_wp, dtype=float) - np.asarray(initial_wp, dtype=float))
+        v = self.rexarm.vel_limits[:len(d)]*vel_scale
+        a = self.rexarm.accel_limits[:len(d)]
+        if profile == "trapezoid":
+            # triangular profile when the joint never reaches cruise speed
+            T = np.where(d > v**2/a, d/v + v/a, 2*np.sqrt(d/a))
+        elif profile == "cubic":
+            T = np.maximum(1.5*d/v, np.sqrt(6.0*d/a))
+        elif profile == "quintic":
+            T = np.maximum(1.875*d/v, np.sqrt(5.7735*d/a))
+        else:
+            raise ValueError("unknown profile {}".format(profile))
+        return T.max()
+
+    def time_grid(self, T):
+        # at least one command period, a zero length move would make M singular
+        T = max(T, self.dt)
+        return T, np.linspace(0.0, T, int(T/self.dt)+1, endpoint=True)
+
+    def spline_coeffs(self, start, end, T):
+        """
+        Polynomial coefficients of every joint from one linear solve.
+        start and end are (k, num_joints) boundary conditions at t = 0 and
+        t = T (position, velocity and, for a quintic, acceleration); the
+        result is (2k, num_joints), lowest order first.
+        """
+        start = np.asarray(start, dtype=float)
+        end = np.asarray(end, dtype=float)
+        k = len(start)
+        n = 2*k
+        p = np.arange(n)
+        M = np.zeros((n, n))
+        for d in range(k):
+            # d-th derivative of t**p is p!/(p-d)! t**(p-d)
+            c = np.array([factorial(i)/factorial(i-d) if i >= d else 0.0 for i in p])
+            M[d, d] = c[d]
+            M[k+d, d:] = c[d:]*T**(p[d:]-d)
+        return np.linalg.solve(M, np.vstack([start, end]))
+
+    def eval_spline(self, A, t):
+        """ Positions and velocities, each (len(t), num_joints), of coefficients A at times t """
+        V = np.vander(t, len(A), increasing=True)
+        return V.dot(A), V[:,:-1].dot(A[1:]*np.arange(1, len(A))[:,np.newaxis])
+
+    def plan_cached(self, profile, *args):
+        """
+        generate_<profile>(*args) through an LRU cache. The key is the
+        profile and every argument rounded to PLAN_CACHE_QUANTUM, so
+        recurring moves (to idle, to a fixed drop point) are only planned
+        once. Cached sample arrays are shared and therefore read-only.
+        """
+        key = (profile,) + tuple(self.quantize(arg) for arg in args)
+        plan = self.plan_cache.get(key)
+        if plan is not None:
+            self.plan_cache.move_to_end(key)
+            self.plan_cache_hits += 1
+            return plan
+        plan = getattr(self, "generate_" + profile)(*args)
+        if plan is not None:
+            for samples in plan:
+                samples.setflags(write=False)
+            self.plan_cache[key] = plan
+            if len(self.plan_cache) > PLAN_CACHE_SIZE:
+                self.plan_cache.popitem(last=False)
+        return plan
+
+    def quantize(self, arg):
+        q = np.round(np.asarray(arg, dtype=float)/PLAN_CACHE_QUANTUM).astype(np.int64)
+        return (q.shape, tuple(q.ravel()))
+
     def generate_cubic_spline(self, initial_wp, final_wp, T):
-        ts = 0.0
-        tf = T
-        N = int((tf-ts)/self.dt)+1
-        t = np.linspace(ts, tf, int(N), endpoint=True)
-        spline_pts = [[]]*self.num_joints
-        spline_velos = [[]]*self.num_joints
-        for j in range(self.num_joints):
-            Qs = [self.initial_wp[j]]
-            Qf = [self.final_wp[j]]
-            Vs = [0]
-            Vf = [0]
-            M = np.array([[1, ts, ts**2, ts**3],
-                          [0, 1,  2*ts, 3*(ts**2)],
-                          [1, tf, tf**2, tf**3],
-                          [0, 1,  2*tf, 3*(tf**2)]])
-            QV = np.array([Qs, Vs, Qf, Vf])
-            QV = QV.T
-            A = np.linalg.inv(M).dot(QV[0])
-            Qt = A[0]+A[1]*t+A[2]*np.power(t,2)+A[3]*np.power(t,3);
-            spline_pts[j]=Qt.tolist()
-            Vt = A[1]+2*A[2]*t+3*A[3]*np.power(t,2)
-            spline_velos[j]=Vt.tolist()
-        plan_pts = np.array(spline_pts).T.tolist()
-        plan_velos = np.array(spline_velos).T.tolist()
-        return plan_pts, plan_velos
+        T, t = self.time_grid(T)
+        zero = np.zeros(len(initial_wp))
+        A = self.spline_coeffs([initial_wp, zero], [final_wp, zero], T)
+        return self.eval_spline(A, t)
 
     def generate_quintic_spline(self, initial_wp, final_wp, T):
-        ts = 0.0
-        tf = T
-        N = int((tf-ts)/self.dt)+1
-        t = np.linspace(ts, tf, int(N), endpoint=True)
-        spline_pts = [[]]*self.num_joints
-        spline_velos = [[]]*self.num_joints
-        for j in range(self.num_joints):
-            Qs = [self.initial_wp[j]]
-            Qf = [self.final_wp[j]]
-            Vs = [0]
-            Vf = [0]
-            As = [0]
-            Af = [0]
-            M = np.array([[1, ts, ts**2, ts**3, ts**4, ts**5],
-                          [0, 1,  2*ts, 3*(ts**2), 4*(ts**3), 5*(ts**4)],
-                          [0, 0, 2, 6*ts, 12*(ts**2), 20*(ts**3)],
-                          [1, tf, tf**2, tf**3, tf**4, tf**5],
-                          [0, 1,  2*tf, 3*(tf**2), 4*(tf**3), 5*(tf**4)],
-                          [0, 0, 2, 6*tf, 12*(tf**2), 20*(tf**3)]])
-            QV = np.array([Qs, Vs, As, Qf, Vf, Af])
-            QV = QV.T
-            A = np.linalg.inv(M).dot(QV[0])
-            Qt = A[0]+A[1]*t+A[2]*np.power(t,2)+A[3]*np.power(t,3)+A[4]*np.power(t,4)+A[5]*np.power(t,5)
-            spline_pts[j]=Qt.tolist()
-            Vt = A[1]+2*A[2]*t+3*A[3]*np.power(t,2)+4*A[4]*np.power(t,3)+5*A[5]*np.power(t,4)
-            spline_velos[j]=Vt.tolist()
-        plan_pts = np.array(spline_pts).T.tolist()
-        plan_velos = np.array(spline_velos).T.tolist()
+        T, t = self.time_grid(T)
+        zero = np.zeros(len(initial_wp))
+        A = self.spline_coeffs([initial_wp, zero, zero], [final_wp, zero, zero], T)
+        return self.eval_spline(A, t)
+
+    def generate_trapezoidal(self, initial_wp, final_wp, T):
+        """
+        Rest to rest trapezoidal velocity profiles finishing together at T.
+        Each joint keeps its own acceleration limit and cruises at the
+        lowest speed that still gets it there in time.
+        """
+        q0 = np.asarray(initial_wp, dtype=float)
+        d = np.asarray(final_wp, dtype=float) - q0
+        T = max(T, self.calc_time_optimal(initial_wp, final_wp))
+        T, t = self.time_grid(T)
+        a = self.rexarm.accel_limits[:len(d)]
+        # cruise speed v solves |d| = v*(T - v/a)
+        v = (a*T - np.sqrt(np.maximum(a**2*T**2 - 4*a*np.abs(d), 0.0)))/2
+        ta = v/a
+        t = t[:,np.newaxis]
+        tr = np.maximum(T - t, 0.0)
+        s = np.where(t < ta, a*t**2/2, np.where(tr < ta, np.abs(d) - a*tr**2/2, v*(t - ta/2)))
+        sd = np.where(t < ta, a*t, np.where(tr < ta, a*tr, v))
+        return q0 + np.sign(d)*s, np.sign(d)*sd
+
+    def generate_multi_waypoint(self, waypoints, durations):
+        """
+        One continuous trajectory through all waypoints, segment i taking
+        durations[i] seconds. Via velocities come from a clamped cubic
+        spline, so velocity and acceleration are continuous and the arm is
+        only at rest at the first and last waypoint.
+        """
+        q = np.asarray(waypoints, dtype=float)
+        h = np.maximum(np.asarray(durations, dtype=float), self.dt)
+        n = len(h)
+        v = np.zeros_like(q)
+        if n > 1:
+            # tridiagonal system for the interior velocities
+            M = np.zeros((n-1, n-1))
+            r = np.zeros((n-1, q.shape[1]))
+            for i in range(1, n):
+                M[i-1, i-1] = 2*(h[i-1]+h[i])
+                if i > 1:
+                    M[i-1, i-2] = h[i]
+                if i < n-1:
+                    M[i-1, i] = h[i-1]
+                r[i-1] = 3*(h[i]*(q[i]-q[i-1])/h[i-1] + h[i-1]*(q[i+1]-q[i])/h[i])
+            v[1:-1] = np.linalg.solve(M, r)
+        knots = np.concatenate([[0.0], np.cumsum(h)])
+        T, t = self.time_grid(knots[-1])
+        seg = np.clip(np.searchsorted(knots, t, side='right')-1, 0, n-1)
+        plan_pts = np.empty((len(t), q.shape[1]))
+        plan_velos = np.empty((len(t), q.shape[1]))
+        for i in range(n):
+            k = (seg == i)
+            A = self.spline_coeffs([q[i], v[i]], [q[i+1], v[i+1]], h[i])
+            plan_pts[k], plan_velos[k] = self.eval_spline(A, t[k]-knots[i])
         return plan_pts, plan_velos
 
+    def start_pose(self, initial_wp):
+        """ Grasp point (x, y, z, phi) of joint vector initial_wp, as used by IK """
+        q = ik_to_dh_angles(np.asarray(initial_wp, dtype=float))
+        return get_pose_from_T(FK_dh_batch(q, l4=L_GRIP)[0])
+
+    def path_to_joints(self, initial_wp, points, phi):
+        """
+        Elbow up IK of (N, 3) points in one batch, in the command convention.
+        Joints IK does not set (the wrist rotations) keep their value from
+        initial_wp. None if a point has no solution within the angle limits.
+        """
+        q0 = np.asarray(initial_wp, dtype=float)
+        angles, valid = IK_batch(points, phi, L_GRIP)
+        if not np.all(valid[:,ELBOW_UP]):
+            return None
+        q = dh_to_ik_angles(angles[:,ELBOW_UP])[:,:len(q0)]
+        hold = [j for j in range(len(q0)) if j not in DH_JOINT]
+        q[:,hold] = q0[hold]
+        limits = self.rexarm.angle_limits[:len(q0)]
+        if np.any(q < limits[:,0]) or np.any(q > limits[:,1]):
+            return None
+        return q
+
+    def generate_cartesian_path(self, initial_wp, path, phi, vel_scale = 1.0):
+        """
+        Joint trajectory that moves the grasp point along path(s), a
+        function from s in [0, 1] to (N, 3) points in mm, with a rest to
+        rest quintic time scaling. The duration is the shortest one that
+        keeps every joint under its velocity limit. All samples are solved
+        in one batch IK call. Returns None if any point is out of reach or
+        the joint path is not continuous (it does not start at initial_wp,
+        or jumps, e.g. across a wrist flip).
+        """
+        q0 = np.asarray(initial_wp, dtype=float)
+        q = self.path_to_joints(q0, path(np.linspace(0.0, 1.0, PATH_CHECK_SAMPLES)), phi)
+        if q is None or np.any(np.abs(q[0] - q0) > PATH_CONTINUITY_TOL) or \
+                np.any(np.abs(np.diff(q, axis=0)) > PATH_CONTINUITY_TOL):
+            return None
+        # the quintic time scaling peaks at ds/dt = 1.875/T
+        dqds = np.abs(np.diff(q, axis=0)).max(axis=0)*(PATH_CHECK_SAMPLES-1)
+        T, t = self.time_grid(1.875*np.max(dqds/(self.rexarm.vel_limits[:len(q0)]*vel_scale)))
+        tau = t/T
+        q = self.path_to_joints(q0, path(10*tau**3 - 15*tau**4 + 6*tau**5), phi)
+        if q is None:
+            return None
+        return q, np.gradient(q, t, axis=0)
 
+    def generate_line(self, initial_wp, final_pose, phi = None, vel_scale = 1.0):
+        """
+        Straight line of the grasp point from initial_wp to final_pose
+        (x, y, z in mm). phi defaults to the approach angle at initial_wp.
+        """
+        start = self.start_pose(initial_wp)
+        if phi is None:
+            phi = start[3]
+        a = start[0:3]
+        b = np.asarray(final_pose[0:3], dtype=float)
+        return self.generate_cartesian_path(initial_wp, lambda s: a + s[:,np.newaxis]*(b - a), phi, vel_scale)
 
+    def generate_arc(self, initial_wp, via_pose, final_pose, phi = None, vel_scale = 1.0):
+        """ Circular arc of the grasp point from initial_wp through via_pose to final_pose """
+        start = self.start_pose(initial_wp)
+        if phi is None:
+            phi = start[3]
+        a = start[0:3]
+        u = np.asarray(via_pose[0:3], dtype=float) - a
+        w = np.asarray(final_pose[0:3], dtype=float) - a
+        n = np.cross(u, w)
+        if np.dot(n, n) < 1e-6*np.dot(u, u)*np.dot(w, w):
+            return self.generate_line(initial_wp, final_pose, phi, vel_scale)
+        # circumcenter of the three points, then an in-plane basis at the start
+        c = a + np.cross(np.dot(u, u)*w - np.dot(w, w)*u, n)/(2*np.dot(n, n))
+        r = np.linalg.norm(a - c)
+        e1 = (a - c)/r
+        e2 = np.cross(n/np.linalg.norm(n), e1)
+        theta = np.arctan2(np.dot(w + a - c, e2), np.dot(w + a - c, e1)) % (2*np.pi)
+        return self.generate_cartesian_path(initial_wp, lambda s: c + r*(np.cos(s*theta)[:,np.newaxis]*e1 +
+                                            np.sin(s*theta)[:,np.newaxis]*e2), phi, vel_scale)
 
     def execute_plan_collect(self, plan_pts, plan_velos, look_ahead=12):
+        """ execute_plan, logging the grasp point of every sample. False if the plan was rejected """
+        violation = self.validate_plan(plan_pts, plan_velos)
+        if violation is not None:
+            print("Plan rejected at sample {} of {}: {}".format(violation[0], len(plan_pts), violation[1]))
+            return False
         #print(len(plan_pts))
         for i in range(len(plan_pts)-look_ahead):
-            self.rexarm.set_positions(plan_pts[i+look_ahead])
-            self.rexarm.set_speeds(plan_velos[i])
+            self.rexarm.set_positions_speeds(list(plan_pts[i+look_ahead]), plan_velos[i])
             with open('traj_fast_smooth.txt', 'a') as file:
                 posesall = self.rexarm.get_positions()
                 endeffectorpos = FK_dh(posesall,0)
                 file.write(str(endeffectorpos)+'\n')
                 #file.write(str(self.rexarm.get_wrist_pose())+'\n')
             self.rexarm.pause(self.dt)
+        return True
 
-    def execute_plan(self, plan_pts, plan_velos, look_ahead=12):
-        #print(len(plan_pts))
-        for i in range(len(plan_pts)-look_ahead):
-            self.rexarm.set_positions(plan_pts[i+look_ahead])
-            self.rexarm.set_speeds(plan_velos[i])
-            self.rexarm.pause(self.dt)
+    def validate_plan(self, plan_pts, plan_velos):
+        """
+        Check every sample of a plan before it is sent: angle limits, the
+        rated servo speeds, height of elbow, wrist and grasp point above the
+        board, and the wrist or gripper entering the base column. All
+        samples are checked at once with batch FK.
+        return None if the plan is valid, else (index, reason) of the first
+        violating sample
+        """
+        q = np.asarray(plan_pts, dtype=float)
+        n = q.shape[1]
+        limits = self.rexarm.angle_limits[:n]
+        max_speeds = np.array([joint.max_speed for joint in self.rexarm.joints])[:n]
+        dh = ik_to_dh_angles(q)
+        elbow = FK_dh_batch(dh, 2)[:,0:3,3]
+        wrist = FK_dh_batch(dh, 3)[:,0:3,3]
+        grip = FK_dh_batch(dh, 4, L_GRIP)[:,0:3,3]
+        def in_base(p):
+            return (np.hypot(p[:,0], p[:,1]) < BASE_RADIUS) & (p[:,2] < DH_D[0])
+        checks = [
+            (np.any((q < limits[:,0]) | (q > limits[:,1]), axis=1), "joint limit"),
+            (np.any(np.abs(np.asarray(plan_velos, dtype=float)) > max_speeds, axis=1), "velocity limit"),
+            ((elbow[:,2] < MIN_LINK_HEIGHT) | (wrist[:,2] < MIN_LINK_HEIGHT), "link below board"),
+            (grip[:,2] < MIN_GRIP_HEIGHT, "gripper below board"),
+            (in_base(wrist) | in_base(grip), "collision with base"),
+        ]
+        first = None
+        for bad, reason in checks:
+            if np.any(bad):
+                i = int(np.argmax(bad))
+                if first is None or i < first[0]:
+                    first = (i, reason)
+        return first
+
+    def execute_plan(self, plan_pts, plan_velos, look_ahead=None):
+        """ Validate and execute a sampled plan, False if it was rejected """
+        violation = self.validate_plan(plan_pts, plan_velos)
+        if violation is not None:
+            print("Plan rejected at sample {} of {}: {}".format(violation[0], len(plan_pts), violation[1]))
+            return False
+        self.execute_stream(zip(plan_pts, plan_velos), look_ahead)
+        return True
+
+    def look_ahead(self):
+        """ Samples to lead the commanded position by: servo lag plus measured bus latency """
+        return int(np.clip(np.ceil((SERVO_LAG + self.rexarm.latency)/self.dt), 1, MAX_LOOK_AHEAD))
 
+    def execute_stream(self, samples, look_ahead=None):
+        """
+        Command (position, velocity) samples from any iterable at the
+        command rate. The position is taken look_ahead samples ahead of the
+        velocity, adapted every tick from the measured bus latency when
+        look_ahead is None, and clamped to the last sample, so the lead
+        shrinks over the end of the plan and a plan shorter than the
+        look-ahead still follows its path. Ticks are scheduled against
+        absolute monotonic deadlines so bus time does not accumulate as
+        drift; a tick that falls more than a period behind skips the
+        samples it missed. Returns once the arm has settled on the last
+        sample (see settle()), so the next plan starts where this one
+        ended. Timing of the last run is left in self.exec_stats.
+        """
+        samples = iter(samples)
+        pts = []
+        velos = []
+        done = False
+        jitter = []
+        overruns = 0
+        skipped = 0
+        i = 0
+        start = time.monotonic()
+        while not self.rexarm.estop:
+            L = look_ahead if look_ahead is not None else self.look_ahead()
+            while not done and len(pts) <= i+L:
+                try:
+                    q, v = next(samples)
+                    pts.append(q)
+                    velos.append(v)
+                except StopIteration:
+                    done = True
+            if i >= len(pts):
+                break
+            self.rexarm.set_positions_speeds(list(pts[min(i+L, len(pts)-1)]), velos[i])
+            self.rexarm.get_feedback()
+            i += 1
+            deadline = start + i*self.dt
+            now = time.monotonic()
+            if now > deadline:
+                overruns += 1
+                missed = int((now - deadline)/self.dt)
+                i += missed
+                skipped += missed
+                deadline += missed*self.dt
+            time.sleep(max(deadline - time.monotonic(), 0.0))
+            jitter.append(time.monotonic() - deadline)
+        elapsed = time.monotonic() - start
+        settled = bool(pts) and self.settle(pts[-1], np.abs(velos).max(axis=0))
+        self.exec_stats = dict(ticks = len(jitter), overruns = overruns, skipped = skipped,
+                               period = elapsed/max(len(jitter), 1),
+                               max_jitter = max(jitter) if jitter else 0.0,
+                               latency = self.rexarm.latency, look_ahead = L,
+                               settled = settled, settle_time = time.monotonic() - start - elapsed)
 
+    def settle(self, goal, speeds):
+        """
+        Command goal, also when an overrun skipped it, and wait until every
+        joint is within SETTLE_TOL of it or SETTLE_TIMEOUT has passed.
+        speeds (rad/s), the peak speeds of the plan, let a joint that is
+        still behind catch up. True if the arm settled.
+        """
+        if self.rexarm.estop:
+            return False
+        self.rexarm.set_positions_speeds(list(goal), speeds)
+        timeout = time.monotonic() + SETTLE_TIMEOUT
+        while not self.rexarm.estop:
+            error = np.abs(np.asarray(self.rexarm.get_positions()) - goal)
+            if np.all(error < SETTLE_TOL):
+                return True
+            if time.monotonic() > timeout:
+                return False
+            time.sleep(self.dt)
+        return False